@@ -76,9 +76,9 @@ class GazeBox(Box):
     #  cost to be total gaze density
     @property
     def gaze_heat_density(self):
-        cost_val = np.sum(self._data) / self.size
+        cost_val = self.engine.rect_sum(self.box_tl, self.shape) / self.size
         return cost_val
 
     @property
     def total_heat_density(self):
-        return np.sum(self._s_map) / self._s_map.size
\ No newline at end of file
+        return self.engine.mean_density
\ No newline at end of file
@@ -16,7 +16,9 @@ Licensed under the terms of the GNU General Public License
 # std imports
 import os
 import copy
+import time
 import pickle
+import itertools
 import binascii
 from pathlib import Path
 
@@ -25,7 +27,8 @@ import PIL
 import numpy as np
 
 # module imports
-from ..apti import utilities, directions_factory
+from ..apti import utilities, directions_factory, cost_engine, preprocessing
+from ..apti import image_context
 
 
 class Box(object):
@@ -34,6 +37,10 @@ class Box(object):
     defined as the upper left corner, and dimensions. Indices
     follow the matrix (i,j) convention.
 
+    Position and dimensions are held as plain integers and the box is
+    moved in place, so a box costs a few bytes regardless of how large
+    it is or how many times it is transformed.
+
     #Properties
 
         shape  : Dimensions of the box in (i,j)
@@ -41,19 +48,23 @@ class Box(object):
                  used as the anchor point.
         box_br : Co-ords for the bottom right corner of the box,
                  computed from box_tl & shape.
-        image  : np.array grayscale saliency map which the box is
+        s_map  : np.array grayscale saliency map which the box is
                  to be drawn over.
-        data   : Segment of the image matrix that is covered by the
-                 box. This is updated if the box is translated or
-                 resized.
+        data   : View of the segment of the saliency map that is
+                 covered by the box. Computed on access, so it always
+                 reflects the current position and size.
     """
 
+    __slots__ = ('_s_map', '_engine', '_i', '_j', '_h', '_w', '_min_size',
+                 '_min_area', '_metadata')
+
     def __init__(self,
                  s_map,
                  box_tl,
                  dims,
                  min_size=np.array([0, 0]),
-                 min_area=0):
+                 min_area=0,
+                 engine=None):
         """
         Box object initialiser
         Args:
@@ -63,102 +74,160 @@ class Box(object):
                     computed from box_tl & dims
             dims: Dimensions of the box in (i,j). Presented as shape
                   property later to avoid confusion.
+            min_size: Minimum dimensions in (i,j).
+            min_area: The area of the box must exceed this.
+            engine: optional cost_engine.CostEngine for s_map. If not
+                    given, the engine shared by all boxes on s_map is
+                    looked up (and built on first use).
 
         Raises:
             ValueError: For any invalid dimension. This raise should
                         also be used for any further constraints on
                         the size/shape/position.
         """
-        # check that box_tl and dims are non-negative
-        if any(element < 0 for element in box_tl):
-            raise ValueError("Anchor point must be non-negative.")
-        if any(element < 0 for element in dims):
-            raise ValueError("Dimensions must be non-negative.")
         if any(element < 0 for element in min_size):
             raise ValueError("Min size must be non-negative.")
 
-        # check that dimensions are large than min_size
-        if dims[0] < min_size[0]:
-            raise ValueError("i'th dimension is less than minimum size.")
-        if dims[1] < min_size[1]:
-            raise ValueError("j'th dimension is less than minimum size.")
-
-        # check if area is less than min_area
-        if dims[0] * dims[1] <= min_area:
-            raise ValueError("area must exceed minimum area")
-
         # assign vars
-        self._box_tl = box_tl
-        self._dims = dims
         self._s_map = s_map
-        self._min_size = min_size
-        # compute and check box_br
-        box_br = np.add(box_tl, dims)
-        if box_br[0] > s_map.shape[0] or box_br[1] > s_map.shape[1]:
-            raise ValueError("Box drawn out of range.\n" + str(box_br))
-        else:
-            self._box_br = box_br
-
-        # grab data inside box from s_map
-        # create numpy mask
-        mask_i = np.arange(box_tl[0], box_br[0], 1).tolist()
-        mask_j = np.arange(box_tl[1], box_br[1], 1).tolist()
-        ixgrid = np.ix_(mask_i, mask_j)
-        # assign data
-        self._data = s_map[ixgrid]
+        self._min_size = (int(min_size[0]), int(min_size[1]))
+        self._min_area = min_area
+        if engine is None:
+            engine = cost_engine.get_engine(s_map)
+        self._engine = engine
+
+        i, j = int(box_tl[0]), int(box_tl[1])
+        h, w = int(dims[0]), int(dims[1])
+        reason = self._invalid_reason(i, j, h, w)
+        if reason is not None:
+            raise ValueError(reason)
+        self._i, self._j, self._h, self._w = i, j, h, w
 
         # declare metadata Bunch type and initialise values
         self._metadata = utilities.Bunch(
             box_id=binascii.b2a_hex(os.urandom(15)),
             construction_request=None,  # if made in factory
-            starting_box_tl=box_tl,
-            starting_dims=dims,
+            starting_box_tl=np.array([i, j]),
+            starting_dims=np.array([h, w]),
             n_transformations=0,
+            n_evaluations=0,
             headline_raw=None,
             headline_tl=None,
             headline_br=None,
             history=[],
             cost_history=[],
+            alternatives=None,  # if found by exhaustive search
+            level_timings=None,  # if found by pyramid search
             text_obj=None)
 
+    def _invalid_reason(self, i, j, h, w):
+        """
+        Checks a prospective (tl, dims) against the box constraints.
+        Returns None if valid, otherwise a description of the failure.
+        """
+        # check that box_tl and dims are non-negative
+        if i < 0 or j < 0:
+            return "Anchor point must be non-negative."
+        if h < 0 or w < 0:
+            return "Dimensions must be non-negative."
+        # check that dimensions are large than min_size
+        if h < self._min_size[0]:
+            return "i'th dimension is less than minimum size."
+        if w < self._min_size[1]:
+            return "j'th dimension is less than minimum size."
+        # check if area is less than min_area
+        if h * w <= self._min_area:
+            return "area must exceed minimum area"
+        # check box_br
+        if i + h > self._s_map.shape[0] or j + w > self._s_map.shape[1]:
+            return "Box drawn out of range.\n" + str([i + h, j + w])
+        return None
+
+    # ~~ Pickling ~~ #
+    def __getstate__(self):
+        # the summed-area table is not sent across process boundaries,
+        # it is looked up (or rebuilt once) from s_map on the other side.
+        state = {
+            slot: getattr(self, slot)
+            for slot in Box.__slots__ if slot != '_engine'
+        }
+        # subclasses without __slots__ carry a __dict__ as well
+        state.update(getattr(self, '__dict__', {}))
+        return state
+
+    def __setstate__(self, state):
+        for key, value in state.items():
+            setattr(self, key, value)
+        self._engine = cost_engine.get_engine(self._s_map)
+
+    def __copy__(self):
+        # copies share s_map and engine, but get their own metadata so
+        # that descents from the same starting box don't share a history
+        new_box = object.__new__(type(self))
+        for slot in Box.__slots__:
+            setattr(new_box, slot, getattr(self, slot))
+        if hasattr(self, '__dict__'):
+            new_box.__dict__.update(self.__dict__)
+        new_box._metadata = utilities.Bunch(**self._metadata.__dict__)
+        new_box._metadata.history = list(self._metadata.history)
+        new_box._metadata.cost_history = list(self._metadata.cost_history)
+        return new_box
+
     # ~~ Properties ~~ #
     @property
     def box_tl(self):
-        return self._box_tl
+        return np.array([self._i, self._j])
 
     @property
     def box_br(self):
-        return self._box_br
+        return np.array([self._i + self._h, self._j + self._w])
 
     @property
     def shape(self):
-        return self._dims
+        return np.array([self._h, self._w])
 
     @property
     def size(self):
-        return self._dims[0] * self._dims[1]
+        return self._h * self._w
+
+    @property
+    def rect(self):
+        """
+        (i, j, h, w) tuple identifying the box's state.
+        """
+        return (self._i, self._j, self._h, self._w)
+
+    @property
+    def min_size(self):
+        return np.array(self._min_size)
+
+    @property
+    def min_area(self):
+        return self._min_area
 
     @property
     def data(self):
-        return self._data
+        return self._s_map[self._i:self._i + self._h, self._j:self._j +
+                           self._w]
 
     @property
     def s_map(self):
         return self._s_map
 
+    @property
+    def engine(self):
+        return self._engine
+
     @property
     def cost(self):
         """
-        Calculates the cost bounded by the box.
-        Changing to a more detailed calculation.
+        Calculates the cost bounded by the box: the density of saliency
+        inside the box relative to the mean density of the map. Looked
+        up in O(1) from the shared summed-area table.
         """
-        av_density = np.sum(self._s_map) / (self._s_map.size)
-        box_density = np.sum(self._data) / (self.size)
         #cost_val = (box_density / av_density) + np.sqrt(
         #        (self._s_map.size - self.size) / self._s_map.size)
-        cost_val = box_density / av_density
-        return cost_val
-        #return np.sum(self._data) / (self.shape[0] * self.shape[1])**2
+        return self._engine.cost((self._i, self._j), (self._h, self._w))
 
     @property
     def metadata(self):
@@ -170,10 +239,23 @@ class Box(object):
         return self._metadata
 
     # ~~ Methods ~~ #
+    def transformed_cost(self, vector):
+        """
+        Cost the box would have after transform(vector), without moving
+        it. Returns None if the transformed box would be invalid.
+        """
+        i = self._i + int(vector[0][0])
+        j = self._j + int(vector[0][1])
+        h = self._h + int(vector[1][0])
+        w = self._w + int(vector[1][1])
+        if self._invalid_reason(i, j, h, w) is not None:
+            return None
+        return self._engine.cost((i, j), (h, w))
+
     def transform(self, vector, record_transformation=False):
         """
-        Transforms the box according to the specified vector by
-        calling the translate and resize methods
+        Transforms the box in place according to the specified vector.
+        The box is left unchanged if the result would be invalid.
 
         Args:
             vector: Compound vector of shape 2x2. The first element is the
@@ -182,28 +264,47 @@ class Box(object):
             record_transformation: Bool to allow addition of provided vector to
                                    the metadata.history
         Returns:
-            N/A: modifies self by calling resize and translate (consider returning
-                 success flag if necessary?
+            N/A: modifies self
         Raises:
+            ValueError: if the transformed box violates any constraint.
         """
-        # cache metadata
-        metadata = self._metadata
-        # translate box
-        new_anchor = np.add(self._box_tl, vector[0])
-        self.__init__(self.s_map, new_anchor, self.shape, self._min_size)
-        # resize box
-        new_dims = np.add(self._dims, vector[1])
-        self.__init__(self.s_map, self.box_tl, new_dims, self._min_size)
-        # reassign metadata
-        self._metadata = metadata
+        i = self._i + int(vector[0][0])
+        j = self._j + int(vector[0][1])
+        h = self._h + int(vector[1][0])
+        w = self._w + int(vector[1][1])
+        reason = self._invalid_reason(i, j, h, w)
+        if reason is not None:
+            raise ValueError(reason)
+        self._i, self._j, self._h, self._w = i, j, h, w
         # update metadata history if required
         if record_transformation:
             self._metadata.history.append(vector)
 
+    def image_coords(self, image_shape):
+        """
+        Maps the box from s_map to an image of image_shape (i,j) that
+        s_map was computed from at a different (working) resolution.
+        Each edge is rounded to the nearest pixel independently, so a
+        box flush with an edge of s_map stays flush with the image.
+        Args:
+            image_shape: (i,j) shape of the target image.
+        Returns:
+            (box_tl, box_br, dims) in image co-ordinates.
+        Raises:
+        """
+        image_shape = np.array(image_shape[:2])
+        scale = image_shape / np.array(self._s_map.shape[:2])
+        box_tl = np.clip(np.rint(self.box_tl * scale), 0,
+                         image_shape).astype(int)
+        box_br = np.clip(np.rint(self.box_br * scale), 0,
+                         image_shape).astype(int)
+        return box_tl, box_br, box_br - box_tl
+
     def overlay_box(self, image):
         """
         Overlays a blue box on the image provided (note, not on own
-        image).
+        image). If the image is a different size to s_map the box is
+        mapped to it with image_coords.
         Args:
             image: np.array or PIL.Image.Image of the image that the
             box is to be drawn on.
@@ -211,13 +312,17 @@ class Box(object):
             img_with_overlay: The image with the overlaid box.
         Raises:
         """
+        if isinstance(image, PIL.Image.Image):
+            box_tl, box_br, _ = self.image_coords(image.size[::-1])
+        else:
+            box_tl, box_br, _ = self.image_coords(image.shape)
 
         # define tuples for cv2.rectangle
         colour = (255, 0, 0)
         # cv2.rectangle requires corner co-ordinates to be in (x,y) not (i,j)
         # so indices are flipped.
-        tl_tuple = tuple(np.flip(self.box_tl, 0))
-        br_tuple = tuple(np.flip(self.box_br, 0))
+        tl_tuple = tuple(int(x) for x in np.flip(box_tl, 0))
+        br_tuple = tuple(int(x) for x in np.flip(box_br, 0))
 
         # Handle CV images
         if isinstance(image, np.ndarray):
@@ -246,8 +351,7 @@ class Box(object):
             # copy image
             img_with_overlay = copy.copy(image)
             # dims are reversed to conform with PIL.ImageDraw.Draw.rectangle() [xy not ij]
-            dims = ((self.box_br[1], self.box_br[0]), (self.box_tl[1],
-                                                       self.box_tl[0]))
+            dims = ((box_br[1], box_br[0]), (box_tl[1], box_tl[0]))
             # get stroke width from image dimensions
             stroke_width = utilities.estimate_stroke_width(
                 img_with_overlay.size)
@@ -272,7 +376,8 @@ class Box(object):
         # ##save_path = save_path + "/" + str(self._metadata.box_id) + ".avi"
 
         temp_box = Box(self.s_map, self._metadata.starting_box_tl,
-                       self._metadata.starting_dims, self._min_size)
+                       self._metadata.starting_dims, self._min_size,
+                       self._min_area, engine=self._engine)
         print("Saving video to : ", save_path)
         # initialise writer
         cv2.VideoWriter_fourcc(*'X264')
@@ -294,14 +399,23 @@ class Box(object):
 
     def write_to_file(self,
                       folderpath,
-                      imagepath,
+                      image,
                       headline=None,
                       video_ext=".avi"):
         """
-        Writes box + video + metadata to folderpath
+        Writes box + video + metadata to folderpath. image is the
+        ImageContext the box was found on (or the Path of the image, which
+        is then decoded).
+
+        Raises:
+            ValueError: if image wasn't loaded from a file, as the
+                        output files are named after it.
         """
-        # get image name from imagepath Path (remove file extension)
-        image_name = imagepath.stem
+        image = image_context.as_context(image)
+        # get image name from imagepath Path (remove file extension).
+        # Raises ValueError if the image has no path.
+        image_name = image.name
+        imagepath = image.path
         if self.metadata.construction_request is not None:
             request_name = self.metadata.construction_request[0] + "_"
         else:
@@ -315,21 +429,20 @@ class Box(object):
         metapkl_path = folderpath / Path("metadata_" + request_name + str(image_name) + ".pkl")
         # yapf: enable
 
-        # load image
-        image = cv2.imread(str(imagepath))
-
         if headline is not None:
-            pil_image = PIL.Image.open(imagepath)
             # write headline on image and save
             outhl_path = folderpath / Path("headline_" + request_name +
                                            str(image_name) + ".png")
+            # the box is drawn in image co-ordinates, which differ from
+            # s_map's if the map was computed at a working resolution
+            box_tl, box_br, dims = self.image_coords(image.bgr.shape)
             outhl, self.metadata.headline_tl, self.metadata.headline_br = headline.draw(
-                pil_image, self.box_tl, self.box_br, self.shape)
+                image, box_tl, box_br, dims)
 
             outhl.save(outhl_path)
 
         # write box image
-        outimg = self.overlay_box(image)
+        outimg = self.overlay_box(image.bgr)
         cv2.imwrite(str(outimg_path), outimg)
         # write box on smap
         outsmap = self.overlay_box(self._s_map)
@@ -351,10 +464,289 @@ class Box(object):
 # ========================= /class ========================
 
 
+def evaluate_candidates(box, directions_list, step_size=1, use_memo=False):
+    """
+    Evaluates every move in directions_list from the current box in
+    one vectorised pass over the shared summed-area table.
+
+    Args:
+        box: Box object to be moved. It is not modified.
+        directions_list: (n_dirs, 2, 2) array of compound vectors, in the
+                         format used by directions_factory.
+        step_size: number of pixels each unit of a direction moves.
+        use_memo: read and fill the cost memo shared by all descents on
+                  the map (see cost_engine.CostMemo). Slower than the
+                  plain table lookup; see CostEngine.cached_costs.
+    Returns:
+        costs: (n_dirs,) float64 array of the cost of each candidate.
+               Candidates that would be out of bounds, smaller than
+               min_size, or not exceed min_area are given np.inf.
+    Raises:
+    """
+    vectors = step_size * np.asarray(directions_list)
+    box_tl = box.box_tl + vectors[:, 0]
+    dims = box.shape + vectors[:, 1]
+    box_br = box_tl + dims
+
+    # mask out invalid candidates (see Box._invalid_reason)
+    valid = np.all(box_tl >= 0, axis=1)
+    valid &= np.all(dims >= np.maximum(box.min_size, 0), axis=1)
+    valid &= dims[:, 0] * dims[:, 1] > box.min_area
+    valid &= np.all(box_br <= box.s_map.shape[:2], axis=1)
+
+    costs = np.full(len(vectors), np.inf)
+    if use_memo:
+        costs[valid] = box.engine.cached_costs(box_tl[valid], dims[valid])
+    else:
+        costs[valid] = box.engine.costs(box_tl[valid], dims[valid])
+    return costs
+
+
+def exhaustive_search(starting_box, grid_step=None, shape_step=None,
+                      top_k=5):
+    """
+    Finds the global minimum of the cost by evaluating every admissible
+    (box_tl, dims) pair on a pixel grid. For each candidate shape the
+    cost of every position is computed at once from the summed-area
+    table, so the work is n_shapes * n_positions lookups.
+
+    Args:
+        starting_box: Box object supplying the saliency map and the
+                      min_size/min_area constraints. It is not modified.
+        grid_step: pixel spacing of the box_tl grid. Defaults to the
+                   spacing giving ~64 positions along the longest side,
+                   which keeps the runtime independent of image size.
+        shape_step: pixel spacing of the dims grid. Defaults to the
+                    spacing giving ~32 sizes along the longest side.
+        top_k: number of lowest-cost placements to keep.
+    Returns:
+        optimum_box: copy of starting_box moved to the global minimum.
+                     metadata.alternatives holds the top_k placements as
+                     (box_tl, dims, cost) tuples in ascending cost, the
+                     first of which is the optimum itself.
+    Raises:
+        ValueError: if no admissible box exists on the grid.
+    """
+    engine = starting_box.engine
+    table = engine.table
+    img_i, img_j = engine.shape
+    min_size = starting_box.min_size
+    if grid_step is None:
+        grid_step = max(1, int(np.ceil(max(img_i, img_j) / 64)))
+    if shape_step is None:
+        shape_step = max(1, int(np.ceil(max(img_i, img_j) / 32)))
+
+    # running pool of the best placements as rows of (cost, i, j, h, w)
+    best = np.empty((0, 5))
+    for h in range(max(min_size[0], 1), img_i + 1, shape_step):
+        for w in range(max(min_size[1], 1), img_j + 1, shape_step):
+            if h * w <= starting_box.min_area:
+                continue
+            # cost field over every grid position for this shape
+            field = (table[h::grid_step, w::grid_step] -
+                     table[:img_i + 1 - h:grid_step, w::grid_step] -
+                     table[h::grid_step, :img_j + 1 - w:grid_step] +
+                     table[:img_i + 1 - h:grid_step, :img_j + 1 - w:grid_step])
+            field = field.ravel() / (h * w * engine.mean_density)
+            # keep only this shape's top_k
+            if field.size > top_k:
+                indices = np.argpartition(field, top_k - 1)[:top_k]
+            else:
+                indices = np.arange(field.size)
+            n_cols = len(range(0, img_j + 1 - w, grid_step))
+            shape_best = np.column_stack(
+                (field[indices], grid_step * (indices // n_cols),
+                 grid_step * (indices % n_cols), np.full(len(indices), h),
+                 np.full(len(indices), w)))
+            best = np.concatenate((best, shape_best))
+            if len(best) > 4 * top_k:
+                best = best[np.argsort(best[:, 0], kind='stable')[:top_k]]
+
+    if len(best) == 0:
+        raise ValueError("exhaustive_search: no admissible box on the grid.")
+    best = best[np.argsort(best[:, 0], kind='stable')[:top_k]]
+    alternatives = [(row[1:3].astype(int), row[3:5].astype(int), row[0])
+                    for row in best]
+
+    # move a copy of the starting box to the optimum in a single step
+    optimum_box = copy.copy(starting_box)
+    opt_tl, opt_dims, opt_cost = alternatives[0]
+    optimum_box.transform(
+        np.array([opt_tl - optimum_box.box_tl, opt_dims - optimum_box.shape]),
+        record_transformation=True)
+    optimum_box.metadata.cost_history.append(opt_cost)
+    optimum_box.metadata.n_transformations += 1
+    optimum_box.metadata.alternatives = alternatives
+    return optimum_box
+
+
+def _fit_to_level(s_map, box_tl, dims, min_size, min_area, engine=None):
+    """
+    Constructs a Box on s_map at the given position and size, clipped so
+    that it is in bounds and satisfies min_size. Used when carrying a
+    box between pyramid levels where rounding can push it off the map.
+    """
+    img_shape = np.array(s_map.shape[:2])
+    dims = np.maximum(dims, min_size)
+    if dims[0] * dims[1] <= min_area:
+        # grow in proportion until the area constraint is met
+        dims = np.ceil(dims * np.sqrt((min_area + 1) / (dims[0] * dims[1])))
+    dims = np.minimum(dims, img_shape).astype(int)
+    box_tl = np.clip(box_tl, 0, img_shape - dims)
+    return Box(s_map, box_tl, dims, min_size, min_area, engine=engine)
+
+
+def pyramid_search(starting_box, coarse_side=64, radius=2):
+    """
+    Coarse-to-fine placement. The saliency map is reduced to a pyramid
+    (see preprocessing.build_pyramid), the global minimum is found at
+    the coarsest level by exhaustive search, and the box is then carried
+    to each finer level and refined within a small neighbourhood. The
+    cost is a relative density, so it is comparable between levels.
+
+    Args:
+        starting_box: Box object supplying the saliency map and the
+                      min_size/min_area constraints. It is not modified.
+        coarse_side: longest side of the coarsest level, in pixels.
+        radius: at each finer level every combination of moving each
+                edge of the box by up to radius pixels is tried.
+    Returns:
+        optimum_box: copy of starting_box moved to the optimum.
+                     metadata.level_timings holds (level shape, seconds)
+                     for each level from coarsest to finest, and
+                     metadata.cost_history the cost found at each level.
+    Raises:
+    """
+    pyramid = preprocessing.build_pyramid(starting_box.s_map, coarse_side)
+    full_shape = np.array(starting_box.s_map.shape[:2])
+    level_timings = []
+    level_costs = []
+    # every (tl, dims) offset within radius, as compound direction vectors
+    offsets = range(-radius, radius + 1)
+    neighbourhood = np.array(list(itertools.product(
+        offsets, repeat=4))).reshape(-1, 2, 2)
+
+    # solve the coarsest level globally
+    start = time.perf_counter()
+    scale = np.array(pyramid[-1].shape[:2]) / full_shape
+    level_box = _fit_to_level(pyramid[-1], [0, 0], pyramid[-1].shape[:2],
+                              (starting_box.min_size * scale).astype(int),
+                              starting_box.min_area * scale.prod())
+    level_box = exhaustive_search(level_box, grid_step=1, shape_step=1,
+                                  top_k=1)
+    level_timings.append((pyramid[-1].shape[:2],
+                          time.perf_counter() - start))
+    level_costs.append(level_box.cost)
+
+    # carry the box down the pyramid, refining at each level
+    for level, s_map in reversed(list(enumerate(pyramid[:-1]))):
+        start = time.perf_counter()
+        ratio = np.array(s_map.shape[:2]) / np.array(
+            level_box.s_map.shape[:2])
+        if level == 0:
+            min_size, min_area = starting_box.min_size, starting_box.min_area
+            engine = starting_box.engine
+        else:
+            scale = np.array(s_map.shape[:2]) / full_shape
+            min_size = (starting_box.min_size * scale).astype(int)
+            min_area = starting_box.min_area * scale.prod()
+            engine = None
+        level_box = _fit_to_level(
+            s_map, np.round(level_box.box_tl * ratio).astype(int),
+            np.round(level_box.shape * ratio).astype(int), min_size,
+            min_area, engine)
+        costs = evaluate_candidates(level_box, neighbourhood)
+        best_index = np.argmin(costs)
+        if costs[best_index] < level_box.cost:
+            level_box.transform(neighbourhood[best_index])
+        level_timings.append((s_map.shape[:2], time.perf_counter() - start))
+        level_costs.append(level_box.cost)
+
+    # move a copy of the starting box to the optimum in a single step
+    optimum_box = copy.copy(starting_box)
+    optimum_box.transform(
+        np.array([
+            level_box.box_tl - optimum_box.box_tl,
+            level_box.shape - optimum_box.shape
+        ]),
+        record_transformation=True)
+    optimum_box.metadata.cost_history.extend(level_costs)
+    optimum_box.metadata.n_transformations += 1
+    optimum_box.metadata.level_timings = level_timings
+    return optimum_box
+
+
+def adaptive_descent(starting_box,
+                     directions_list,
+                     step_size=10,
+                     n_iterations=10000,
+                     use_memo=False):
+    """
+    Descent with an adaptive step. Each iteration picks the best
+    direction at the current step, then line searches along it, doubling
+    the stride for as long as the cost keeps falling. When no direction
+    improves the cost the step is halved, and the descent ends once the
+    step drops below 1 pixel.
+
+    Args:
+        starting_box: Box object located at the desired starting position of
+                      the descent.
+        directions_list: as for minimise_cost.
+        step_size: initial step in pixels.
+        n_iterations: maximum number of iterations.
+        use_memo: as for minimise_cost.
+    Returns:
+        optimum_box: This is the best box position according to the algorithm.
+                     metadata.cost_history, n_transformations (iterations)
+                     and n_evaluations are recorded as for the fixed-step
+                     descent so the two can be compared.
+    Raises:
+    """
+    optimum_box = copy.copy(starting_box)
+    metadata = optimum_box.metadata
+    directions_list = np.asarray(directions_list)
+    step = int(step_size)
+    current_cost = optimum_box.cost
+    for iteration in range(n_iterations):
+        candidate_costs = evaluate_candidates(optimum_box, directions_list,
+                                              step, use_memo=use_memo)
+        metadata.n_evaluations += len(directions_list)
+        metadata.n_transformations += 1
+        best_index = np.argmin(candidate_costs)
+        if candidate_costs[best_index] >= current_cost:
+            # no move improves: refine the step
+            step //= 2
+            metadata.cost_history.append(current_cost)
+            if step < 1:
+                print("Minimum found after", iteration + 1, "iterations")
+                break
+            continue
+
+        best_vector = directions_list[best_index]
+        optimum_box.transform(step * best_vector, record_transformation=True)
+        current_cost = candidate_costs[best_index]
+        # line search along best_vector with a growing stride
+        stride = 2 * step
+        while True:
+            line_cost = optimum_box.transformed_cost(stride * best_vector)
+            metadata.n_evaluations += 1
+            if line_cost is None or line_cost >= current_cost:
+                break
+            optimum_box.transform(
+                stride * best_vector, record_transformation=True)
+            current_cost = line_cost
+            stride *= 2
+        metadata.cost_history.append(current_cost)
+    return optimum_box
+
+
 def minimise_cost(starting_box,
                   directions_list,
                   step_size=10,
-                  n_iterations=10000):
+                  n_iterations=10000,
+                  search="descent",
+                  use_memo=False,
+                  search_options=None):
     """
     Minimises the cost defined by the box class by exploring
     the saliency map space stored in the box.
@@ -369,61 +761,167 @@ def minimise_cost(starting_box,
                          including translation and resizing. Each direction is
                          2 2D vectors. First vector must be for translation,
                          second vector for resizing.
+        search: "descent" for greedy descent from starting_box,
+                "adaptive" for a descent with a variable step (see
+                adaptive_descent),
+                "exhaustive" for the global minimum over the whole map
+                (see exhaustive_search) or "pyramid" for a coarse-to-fine
+                search (see pyramid_search). directions_list, step_size
+                and n_iterations are ignored by the latter two.
+        use_memo: score candidates through the cost memo shared by all
+                  descents on the map (see cost_engine.CostMemo) rather
+                  than straight from the summed-area table. Off by
+                  default: a memo lookup is a Python dict access per
+                  candidate, which is much slower than the vectorised
+                  table lookup it fronts. Only worth it when the memo
+                  will be inspected or the costs are expensive.
+        search_options: optional dict of keyword arguments for the
+                        search mode's function, e.g. dict(grid_step=4,
+                        top_k=10) for exhaustive_search or
+                        dict(coarse_side=32, radius=3) for
+                        pyramid_search. Not used by "descent".
     Returns:
         optimum_box: This is the best box position according to the algorithm.
     Raises:
-        
+        ValueError: for an unknown search mode.
     """
+    if search_options is None:
+        search_options = dict()
+    if search == "exhaustive":
+        return exhaustive_search(starting_box, **search_options)
+    elif search == "pyramid":
+        return pyramid_search(starting_box, **search_options)
+    elif search == "adaptive":
+        return adaptive_descent(starting_box, directions_list, step_size,
+                                n_iterations, use_memo, **search_options)
+    elif search != "descent":
+        raise ValueError("minimise_cost: unknown search mode " + str(search))
 
     optimum_box = copy.copy(starting_box)
-    # loop over n iterations. Each iteration consists of constructing
-    # boxes by moving the current box according to each direction in
-    # direction list. The costs and corresponding direction is recorded
-    # and the minimum cost is selected.
+    directions_list = np.asarray(directions_list)
+    # loop over n iterations. Each iteration evaluates the box moved
+    # according to every direction in directions list in one batch, and
+    # the minimum cost is selected.
     for iteration in range(n_iterations):
-        # create empty candidates list. Stores a list of dictionaries
-        candidate_vectors = [np.array([[0, 0], [0, 0]])]
-        # simple list of costs so we can easily find the minimum
-        candidate_costs = [optimum_box.cost]
-        # loop over all translations/transformations
-        for vector in directions_list:
-            #print("-------------new direction------------")
-            # create new candidate box and move according to vector
-            candidate_box = copy.copy(optimum_box)
-            # try-except block to catch boxes drawn out of bounds
-            try:
-                candidate_box.transform(step_size * vector)
-            except ValueError:
-                # skip invalid boxes
-                continue
-
-            # check that box is valid
-            # print(candidate_box.data)
-            candidate_vectors.append(vector)
-            candidate_costs.append(candidate_box.cost)
-
-        # now we need to select the best candidate
-
-        best_cost = min(candidate_costs)
-        best_vector = candidate_vectors[candidate_costs.index(best_cost)]
+        current_cost = optimum_box.cost
+        candidate_costs = evaluate_candidates(optimum_box, directions_list,
+                                              step_size, use_memo=use_memo)
+        optimum_box.metadata.n_evaluations += len(directions_list)
+        # now we need to select the best candidate. Staying put wins
+        # ties, as does an iteration where every move is invalid.
+        best_index = np.argmin(candidate_costs)
+        if candidate_costs[best_index] < current_cost:
+            best_cost = candidate_costs[best_index]
+            best_vector = directions_list[best_index]
+        else:
+            best_cost = current_cost
+            best_vector = None
         # add best cost to list of cost histories
         optimum_box.metadata.cost_history.append(best_cost)
         optimum_box.metadata.n_transformations += 1
         # check if best_vector is "no step made"
-        if np.all(best_vector == 0):
+        if best_vector is None:
             print("Minimum found after", iteration + 1, "iterations")
             break
 
         # apply best transformation vector to optimum_box
         optimum_box.transform(
             step_size * best_vector, record_transformation=True)
-        #print("Box ID: ", optimum_box.metadata.box_id)
-        #print(best_vector)
-        #print(best_cost)
     # Put optimum box printout here if necessary
     return optimum_box
 
 
+def minimise_costs_batched(boxes_list,
+                           directions_lists,
+                           step_size=10,
+                           n_iterations=10000):
+    """
+    Runs the fixed-step descent of minimise_cost for several starting
+    boxes in lock-step, in one process. The current rectangles are held
+    as one array and each iteration scores every candidate of every
+    still-active box in a single pass over the shared summed-area table.
+    Boxes drop out as they converge.
+
+    Args:
+        boxes_list: list of Box objects on the same saliency map.
+        directions_lists: list of direction arrays, one per box. They
+                          may have different lengths.
+        step_size: int, or list with one step per box.
+        n_iterations: int, or list with one iteration limit per box.
+    Returns:
+        optimum_boxes: list of Box objects in the order of boxes_list,
+                       with metadata as recorded by minimise_cost.
+    Raises:
+        ValueError: if the boxes do not share a saliency map.
+    """
+    if not boxes_list:
+        return []
+    engine = boxes_list[0].engine
+    if any(box.engine is not engine for box in boxes_list):
+        raise ValueError(
+            "minimise_costs_batched: boxes must share a saliency map.")
+    n_boxes = len(boxes_list)
+    optimum_boxes = [copy.copy(box) for box in boxes_list]
+    step_size = np.broadcast_to(np.asarray(step_size), (n_boxes, ))
+    n_iterations = np.broadcast_to(np.asarray(n_iterations), (n_boxes, ))
+
+    # pad the direction sets to a common length. Padding is masked out.
+    n_dirs = max(len(directions) for directions in directions_lists)
+    vectors = np.zeros((n_boxes, n_dirs, 4), dtype=int)
+    padding = np.ones((n_boxes, n_dirs), dtype=bool)
+    for index, directions in enumerate(directions_lists):
+        directions = np.asarray(directions).reshape(-1, 4)
+        vectors[index, :len(directions)] = step_size[index] * directions
+        padding[index, :len(directions)] = False
+
+    # per-box state and constraints as arrays of (i, j, h, w) etc.
+    rects = np.array([box.rect for box in optimum_boxes])
+    min_size = np.maximum([box.min_size for box in optimum_boxes], 0)
+    min_area = np.array([box.min_area for box in optimum_boxes])
+    img_shape = np.array(engine.shape)
+    current_costs = engine.costs(rects[:, :2], rects[:, 2:])
+    active = np.flatnonzero(n_iterations > 0)
+
+    iteration = 0
+    while len(active):
+        candidates = rects[active, None, :] + vectors[active]
+        box_tl = candidates[..., :2]
+        dims = candidates[..., 2:]
+        # mask out invalid candidates (see Box._invalid_reason)
+        valid = ~padding[active]
+        valid &= np.all(box_tl >= 0, axis=2)
+        valid &= np.all(dims >= min_size[active, None], axis=2)
+        valid &= dims[..., 0] * dims[..., 1] > min_area[active, None]
+        valid &= np.all(box_tl + dims <= img_shape, axis=2)
+        costs = np.full(valid.shape, np.inf)
+        costs[valid] = engine.costs(box_tl[valid], dims[valid])
+
+        best_indices = np.argmin(costs, axis=1)
+        best_costs = costs[np.arange(len(active)), best_indices]
+        still_active = []
+        for row, index in enumerate(active):
+            box = optimum_boxes[index]
+            box.metadata.n_evaluations += len(directions_lists[index])
+            box.metadata.n_transformations += 1
+            # staying put wins ties
+            if not best_costs[row] < current_costs[index]:
+                box.metadata.cost_history.append(current_costs[index])
+                print("Minimum found after", iteration + 1, "iterations")
+                continue
+            box.metadata.cost_history.append(best_costs[row])
+            box.transform(
+                vectors[index, best_indices[row]].reshape(2, 2),
+                record_transformation=True)
+            rects[index] = candidates[row, best_indices[row]]
+            current_costs[index] = best_costs[row]
+            if iteration + 1 < n_iterations[index]:
+                still_active.append(index)
+        active = np.array(still_active, dtype=int)
+        iteration += 1
+
+    return optimum_boxes
+
+
 def main():
     """
     For testing only.
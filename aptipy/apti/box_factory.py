@@ -18,13 +18,14 @@ Licensed under the terms of the GNU General Public License
 
 # std imports
 import os
+import copy
 from multiprocessing import Pool
 from multiprocessing import cpu_count
 from pathlib import Path
 import numpy as np
 import cv2
 # module imports
-from ..apti import bounding_box
+from ..apti import bounding_box, cost_engine, shared_map, image_context
 
 
 def positions_list():
@@ -56,20 +57,42 @@ class BoxFactory(object):
     box. Should be able to create multiple boxes .
     """
 
-    def __init__(self, s_map, headline=None):
+    def __init__(self, s_map, headline=None, image=None, constraints=None):
+        """
+        image is the ImageContext s_map was computed from, and which the
+        headline will be drawn on. If s_map was computed at a different
+        (working) resolution, the headline's size constraints, which are
+        measured in image pixels, are scaled to s_map.
+        constraints is an optional (min_size, min_area) pair for the
+        headline, such as Requester.constraints returns, used instead of
+        measuring the headline.
+        """
         self._s_map = s_map
+        self._image = image
+        # one summed-area table shared by every box on this map
+        self._engine = cost_engine.get_engine(s_map)
         # initialise requests list
         self._requests_list = None
 
         if headline is not None:
             self._text_ctx = headline
-            self._min_size, self._min_area = headline.get_constraints()
+            if constraints is None:
+                constraints = headline.get_constraints()
+            self._min_size, self._min_area = constraints[0], constraints[1]
+            if image is not None:
+                scale = np.array(s_map.shape[:2]) / np.array(image.shape[:2])
+                self._min_size = np.ceil(self._min_size * scale).astype(int)
+                self._min_area = self._min_area * scale.prod()
         else:
             self._text_ctx = None
             self._min_size = np.array([0, 0])
             self._min_area = 0
 
     # ~~ Properties ~~ #
+    @property
+    def image(self):
+        return self._image
+
     @property
     def positions_list(self):
         return [
@@ -185,7 +208,8 @@ class BoxFactory(object):
             box_tl = request[0]
             box_dims = request[1]
             box = bounding_box.Box(self._s_map, box_tl, box_dims,
-                                   self._min_size, self._min_area)
+                                   self._min_size, self._min_area,
+                                   engine=self._engine)
             # add request metadata
             box.metadata.construction_request = requests_readable[index]
             box.metadata.text_obj = self._text_ctx.__dict__
@@ -193,13 +217,44 @@ class BoxFactory(object):
         return boxes_list
 
 
+def default_num_workers():
+    """
+    cpu_count - 1 workers to prevent complete CPU lockup, but at least one.
+    """
+    return max(1, cpu_count() - 1)
+
+
+def init_worker():
+    """
+    Pool initialiser, run once per worker process. Each worker runs a
+    single descent at a time, so OpenCV's own threading is switched off
+    to avoid oversubscribing the cores.
+    """
+    cv2.setNumThreads(1)
+
+
 def minimise_boxes(boxes_list,
                    directions_lists,
                    step_size=5,
-                   n_iterations=10000):
+                   n_iterations=10000,
+                   search="descent",
+                   backend="pool",
+                   pool=None,
+                   search_options=None):
     """
     Utilises multiprocessing.Pool to minimise multiple boxes simultaneously. 
     num workers is cpu_count - 1 to prevent complete CPU lockup.
+    search and search_options (e.g. the grid of an exhaustive search)
+    are passed through to bounding_box.minimise_cost.
+
+    With backend="batched" the boxes are minimised in this process
+    instead. Descents run in lock-step on the shared summed-area table
+    (see bounding_box.minimise_costs_batched); other search modes run
+    one after another. This avoids the pool start-up and pickling cost,
+    which dominates for a single small image.
+
+    An already open pool can be passed in to reuse its workers across
+    calls (see main.run_batch); it is left open.
     """
     # check if step size is a list or int
     # if int, make into list of ints so it can be passed to starmap
@@ -231,28 +286,113 @@ def minimise_boxes(boxes_list,
         raise ValueError(
             "minimise_boxes: argument arrays must have equal lengths.")
 
+    if backend == "batched":
+        if search == "descent":
+            return bounding_box.minimise_costs_batched(
+                boxes_list, directions_lists, step_size, n_iterations)
+        return [
+            bounding_box.minimise_cost(
+                *args, search=search, search_options=search_options)
+            for args in zip(boxes_list, directions_lists, step_size,
+                            n_iterations)
+        ]
+    elif backend != "pool":
+        raise ValueError("minimise_boxes: unknown backend " + str(backend))
+
+    # boxes on one saliency map share it with the workers through a
+    # memory-mapped file; the workers send back compact results.
+    s_map = boxes_list[0].s_map
+    if all(box.s_map is s_map for box in boxes_list):
+        with shared_map.SharedMap(s_map, boxes_list[0].engine) as shared:
+            args_iterable = [
+                (shared.handle, box.rect, box.min_size, box.min_area,
+                 directions, step, iterations, search, search_options)
+                for box, directions, step, iterations in zip(
+                    boxes_list, directions_lists, step_size, n_iterations)
+            ]
+            results = _run_on_pool(minimise_shared, args_iterable, pool)
+        return [
+            box_from_result(box, result)
+            for box, result in zip(boxes_list, results)
+        ]
+
     # repack boxes_list directions_lists step_size and n_iterations into an iterable
     # such that: [(1,2), (3,4)] -> [func(1,2), func(3,4)]
-    args_iterable = zip(boxes_list, directions_lists, step_size, n_iterations)
+    args_iterable = zip(boxes_list, directions_lists, step_size, n_iterations,
+                        [search] * len(boxes_list),
+                        [False] * len(boxes_list),
+                        [search_options] * len(boxes_list))
+    return _run_on_pool(bounding_box.minimise_cost, args_iterable, pool)
+
+
+def _run_on_pool(func, args_iterable, pool=None):
     """
-    args_iterable = []
-    for index in range(len(boxes_list)):
-        arguments = (boxes_list[index], directions_lists[index], step_size[index], n_iterations[index])
-        args_iterable.append(arguments)
+    starmap on the given pool, or on a pool opened for this call.
     """
+    if pool is not None:
+        return pool.starmap(func, args_iterable)
+
     # get process number and open pool
-    num_workers = cpu_count() - 1
+    num_workers = default_num_workers()
     print("Opening pool")
-    with Pool(processes=num_workers) as pool:
-        optimum_boxes = pool.starmap(bounding_box.minimise_cost, args_iterable)
+    with Pool(processes=num_workers, initializer=init_worker) as pool:
+        results = pool.starmap(func, args_iterable)
         pool.close()
         print("Pool closed")
         pool.join()
 
-    return optimum_boxes
+    return results
+
 
+# metadata fields that a worker sends back to the parent
+RESULT_FIELDS = ('history', 'cost_history', 'n_transformations',
+                 'n_evaluations', 'alternatives', 'level_timings')
 
-def write_boxes(boxes_list, folderpath, imagepath, headline=None):
+
+def minimise_shared(handle,
+                    rect,
+                    min_size,
+                    min_area,
+                    directions,
+                    step_size,
+                    n_iterations,
+                    search,
+                    search_options=None):
+    """
+    Worker-side minimise_cost on a map shared through shared_map.
+    Returns the optimum (i, j, h, w) and a dict of the RESULT_FIELDS
+    metadata rather than a pickled Box.
+    """
+    s_map, engine = shared_map.attach(handle)
+    box = bounding_box.Box(s_map, rect[:2], rect[2:], min_size, min_area,
+                           engine=engine)
+    optimum_box = bounding_box.minimise_cost(
+        box,
+        directions,
+        step_size,
+        n_iterations,
+        search,
+        search_options=search_options)
+    return optimum_box.rect, {
+        field: getattr(optimum_box.metadata, field)
+        for field in RESULT_FIELDS
+    }
+
+
+def box_from_result(starting_box, result):
+    """
+    Rebuilds the optimum Box from a minimise_shared result, as a copy
+    of the starting box moved to the optimum with the worker's metadata.
+    """
+    rect, fields = result
+    box = copy.copy(starting_box)
+    box.transform(np.subtract(rect, box.rect).reshape(2, 2))
+    for field, value in fields.items():
+        setattr(box.metadata, field, value)
+    return box
+
+
+def write_boxes(boxes_list, folderpath, image, headline=None):
     """
     Saves a list of boxes to the folder specified by folderpath.
     Directory structure is created:
@@ -260,10 +400,16 @@ def write_boxes(boxes_list, folderpath, imagepath, headline=None):
             $requestanchor$
                 --files stored here--
     
+    image is the ImageContext the boxes were found on, or the Path of
+    the image, in which case it is decoded once for all of the boxes.
     headline kwarg passess through to box.write_to_file
+
+    Raises ValueError if image wasn't loaded from a file (the directory
+    is named after it) or the directories already exist.
     """
+    image = image_context.as_context(image)
     # create top level directory
-    parent_path = folderpath / Path(imagepath.stem)
+    parent_path = folderpath / Path(image.name)
     if parent_path.is_dir():
         raise ValueError('write_boxes: directory ', str(parent_path),
                          ' exists')
@@ -282,7 +428,7 @@ def write_boxes(boxes_list, folderpath, imagepath, headline=None):
                              " exists")
         box_path.mkdir()
         # write box data to file
-        box.write_to_file(box_path, imagepath, headline=headline)
+        box.write_to_file(box_path, image, headline=headline)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,265 @@
+"""
+cost_engine.py
+
+Summed-area table (integral image) cost engine. Built once per
+saliency map and shared by every Box drawn on that map so that the
+cost of any rectangle is an O(1) lookup.
+
+Copyright © 2018, Naim Sen
+Licensed under the terms of the GNU General Public License
+<https://www.gnu.org/licenses/gpl-3.0.en.html>
+"""
+
+# std imports
+import weakref
+from collections import OrderedDict
+
+import numpy as np
+
+# engines are cached by id(s_map) alongside a weak reference to the map.
+# The entry is dropped when the map is garbage collected, and the weak
+# reference guards against a recycled id matching a stale engine.
+_ENGINE_CACHE = dict()
+
+
+class CostMemo(object):
+    """
+    Bounded least-recently-used memo of rectangle costs, keyed by
+    (i, j, h, w). Counts hits and misses so that the overlap between
+    descents can be measured.
+    """
+
+    def __init__(self, maxsize=65536):
+        self._maxsize = maxsize
+        self._costs = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._costs)
+
+    def __contains__(self, key):
+        return key in self._costs
+
+    def get(self, key):
+        """
+        Returns the memoised cost for key, or None.
+        """
+        cost = self._costs.get(key)
+        if cost is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self._costs.move_to_end(key)
+        return cost
+
+    def put(self, key, cost):
+        """
+        Stores cost for key, evicting the least recently used entry if
+        the memo is full.
+        """
+        self._costs[key] = cost
+        self._costs.move_to_end(key)
+        if len(self._costs) > self._maxsize:
+            self._costs.popitem(last=False)
+
+    def clear(self):
+        self._costs.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+class CostEngine(object):
+    """
+    Summed-area table of a saliency map. Indices follow the matrix
+    (i,j) convention used by Box. The engine does not hold a reference
+    to the map itself so that it can be cached against the map's
+    lifetime (see get_engine).
+
+    #Properties
+
+        shape        : shape of the saliency map in (i,j).
+        size         : number of elements in the saliency map.
+        total        : sum over the whole saliency map.
+        mean_density : total / size, cached on construction.
+        table        : (H+1, W+1) float64 summed-area table with a
+                       leading row and column of zeros.
+        memo         : CostMemo shared by every descent on the map.
+    """
+
+    def __init__(self, s_map):
+        """
+        Args:
+            s_map: np.array grayscale saliency map.
+        Raises:
+            ValueError: if s_map is not two-dimensional.
+        """
+        if np.ndim(s_map) != 2:
+            raise ValueError("CostEngine: saliency map must be 2D.")
+        table = np.zeros((s_map.shape[0] + 1, s_map.shape[1] + 1),
+                         dtype=np.float64)
+        np.cumsum(s_map, axis=0, dtype=np.float64, out=table[1:, 1:])
+        np.cumsum(table[1:, 1:], axis=1, out=table[1:, 1:])
+        self._table = table
+        self._shape = tuple(s_map.shape)
+        self._size = s_map.size
+        self._total = table[-1, -1]
+        self._mean_density = self._total / self._size
+        self._memo = CostMemo()
+
+    @classmethod
+    def from_table(cls, table):
+        """
+        Constructs an engine around an existing summed-area table (e.g.
+        one memory-mapped from disk) without recomputing it.
+        """
+        engine = cls.__new__(cls)
+        engine._table = table
+        engine._shape = (table.shape[0] - 1, table.shape[1] - 1)
+        engine._size = engine._shape[0] * engine._shape[1]
+        engine._total = table[-1, -1]
+        engine._mean_density = engine._total / engine._size
+        engine._memo = CostMemo()
+        return engine
+
+    # ~~ Properties ~~ #
+    @property
+    def shape(self):
+        return self._shape
+
+    @property
+    def size(self):
+        return self._size
+
+    @property
+    def total(self):
+        return self._total
+
+    @property
+    def mean_density(self):
+        return self._mean_density
+
+    @property
+    def table(self):
+        return self._table
+
+    @property
+    def memo(self):
+        return self._memo
+
+    # ~~ Methods ~~ #
+    def rect_sum(self, box_tl, dims):
+        """
+        Sum of the saliency map under the rectangle anchored at box_tl
+        with dimensions dims. No bounds checking is done here; that is
+        the responsibility of the caller (Box validates on construction).
+        """
+        i0 = int(box_tl[0])
+        j0 = int(box_tl[1])
+        i1 = i0 + int(dims[0])
+        j1 = j0 + int(dims[1])
+        table = self._table
+        return (table[i1, j1] - table[i0, j1] - table[i1, j0] +
+                table[i0, j0])
+
+    def cost(self, box_tl, dims):
+        """
+        Box density relative to the mean density of the map.
+        """
+        return self.rect_sum(box_tl, dims) / (int(dims[0]) * int(dims[1])) \
+            / self._mean_density
+
+    def cached_cost(self, box_tl, dims):
+        """
+        cost that reads from and fills the memo. Slower than cost; see
+        cached_costs.
+        """
+        key = (int(box_tl[0]), int(box_tl[1]), int(dims[0]), int(dims[1]))
+        cost_val = self._memo.get(key)
+        if cost_val is None:
+            cost_val = self.cost(box_tl, dims)
+            self._memo.put(key, cost_val)
+        return cost_val
+
+    def rect_sums(self, box_tl, dims):
+        """
+        Vectorised rect_sum.
+        Args:
+            box_tl: (n, 2) integer array of anchor points.
+            dims: (n, 2) integer array of dimensions.
+        Returns:
+            (n,) float64 array of sums.
+        """
+        box_tl = np.asarray(box_tl)
+        box_br = box_tl + np.asarray(dims)
+        table = self._table
+        return (table[box_br[..., 0], box_br[..., 1]] -
+                table[box_tl[..., 0], box_br[..., 1]] -
+                table[box_br[..., 0], box_tl[..., 1]] +
+                table[box_tl[..., 0], box_tl[..., 1]])
+
+    def costs(self, box_tl, dims):
+        """
+        Vectorised cost. See rect_sums for argument shapes.
+        """
+        dims = np.asarray(dims)
+        area = dims[..., 0] * dims[..., 1]
+        return self.rect_sums(box_tl, dims) / area / self._mean_density
+
+    def cached_costs(self, box_tl, dims):
+        """
+        Vectorised cost that reads from and fills the memo. Only the
+        rectangles missing from the memo are looked up in the table.
+        Each rectangle costs a Python dict access, so this is many times
+        slower than costs, which is itself O(1) per rectangle; use it
+        only when the memo's contents or hit counts are wanted.
+        """
+        box_tl = np.asarray(box_tl)
+        dims = np.asarray(dims)
+        keys = [
+            tuple(row)
+            for row in np.concatenate((box_tl, dims), axis=1).tolist()
+        ]
+        costs = np.empty(len(keys))
+        missing = []
+        for index, key in enumerate(keys):
+            cost_val = self._memo.get(key)
+            if cost_val is None:
+                missing.append(index)
+            else:
+                costs[index] = cost_val
+        if missing:
+            costs[missing] = self.costs(box_tl[missing], dims[missing])
+            for index in missing:
+                self._memo.put(keys[index], costs[index])
+        return costs
+
+
+def get_engine(s_map):
+    """
+    Returns the CostEngine for s_map, building it on first request.
+    Subsequent calls with the same array object reuse the engine.
+    """
+    entry = _ENGINE_CACHE.get(id(s_map))
+    if entry is not None:
+        ref, engine = entry
+        if ref() is s_map:
+            return engine
+    engine = CostEngine(s_map)
+    register_engine(s_map, engine)
+    return engine
+
+
+def register_engine(s_map, engine):
+    """
+    Makes engine the one returned by get_engine(s_map), e.g. for an
+    engine whose table was loaded from disk rather than computed.
+    """
+    key = id(s_map)
+    try:
+        ref = weakref.ref(s_map,
+                          lambda _, key=key: _ENGINE_CACHE.pop(key, None))
+    except TypeError:
+        # object can't be weakly referenced; don't cache it
+        return
+    _ENGINE_CACHE[key] = (ref, engine)
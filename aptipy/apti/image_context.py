@@ -0,0 +1,223 @@
+"""
+image_context.py
+
+An image decoded once and shared by every stage of the pipeline
+(saliency, box generation, headline rendering and writing), with the
+BGR, grayscale and PIL RGB views each stage needs. When only a working
+resolution is needed up front, JPEGs are decoded at a reduced scale and
+the full image is decoded later, on first use.
+
+Copyright © 2018, Naim Sen
+Licensed under the terms of the GNU General Public License
+<https://www.gnu.org/licenses/gpl-3.0.en.html>
+"""
+
+# std imports
+import time
+from pathlib import Path
+
+import numpy as np
+import cv2
+from PIL import Image
+
+# module imports
+from ..apti import preprocessing
+
+# cv2.imread flags for decoding at 1/2, 1/4 and 1/8 scale. JPEGs are
+# decoded directly at the reduced scale (much faster than a full
+# decode); other formats are decoded and then resized.
+_REDUCED_FLAGS = {
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8
+}
+# EXIF orientations for which the image is rotated by 90 degrees
+_TRANSPOSED_ORIENTATIONS = (5, 6, 7, 8)
+
+
+class ImageContext(object):
+    """
+    A decoded image. Only the BGR array is decoded; the other views are
+    converted from it on first access and kept.
+
+    #Properties
+
+        path    : Path the image was loaded from (may be None).
+        name    : file name without extension. Raises ValueError if
+                  the image wasn't loaded from a file.
+        shape   : shape of the full-size image in (i,j,channels). Known
+                  without decoding the full image.
+        bgr     : np.array HxWx3 uint8, as returned by cv2.imread.
+                  Decoded on first access if the image was loaded at a
+                  reduced scale.
+        gray    : np.array HxW uint8.
+        rgb     : np.array HxWx3 uint8, channels in RGB order.
+        pil     : PIL.Image.Image (mode RGB) sharing rgb's buffer. PIL
+                  copies it before drawing, so drawing on it does not
+                  modify the other views.
+        timings : dict of seconds spent decoding, under "decode" and
+                  (once the full image has been decoded lazily)
+                  "full_decode".
+    """
+
+    def __init__(self, bgr, path=None, reduced=None, shape=None):
+        """
+        Args:
+            bgr: decoded BGR (or grayscale) image, or None if only the
+                 reduced image has been decoded.
+            path: optional Path of the file bgr was decoded from.
+            reduced: optional reduced-scale decode of the image.
+            shape: shape of the full-size image. Required if bgr is None.
+        """
+        if bgr is not None:
+            bgr = _to_bgr(bgr)
+            shape = bgr.shape
+        self._bgr = bgr
+        self._reduced = reduced
+        self._shape = tuple(shape)
+        self._path = None if path is None else Path(path)
+        self._gray = None
+        self._rgb = None
+        self._pil = None
+        self.timings = dict()
+
+    @classmethod
+    def load(cls, path, working_side=None):
+        """
+        Decodes the image at path. If working_side is given and the
+        image is at least twice as large, it is decoded at the largest
+        reduced scale (1/2, 1/4 or 1/8) whose longest side is still at
+        least working_side, and the full image is only decoded when it
+        is first needed (e.g. to render the headline).
+
+        Raises:
+            ValueError: if the image can't be found or loaded.
+        """
+        path = Path(path)
+        if not path.is_file():
+            raise ValueError("Invalid image file path. File does not exist.")
+        start = time.perf_counter()
+        reduction = 1
+        if working_side is not None:
+            shape = read_shape(path)
+            if shape is not None:
+                reduction = max([1] + [
+                    factor for factor in _REDUCED_FLAGS
+                    if -(-max(shape[:2]) // factor) >= working_side
+                ])
+        if reduction == 1:
+            context = cls(_imread(path), path)
+        else:
+            reduced = _to_bgr(_imread(path, _REDUCED_FLAGS[reduction]))
+            context = cls(None, path, reduced=reduced, shape=shape)
+        context.timings["decode"] = time.perf_counter() - start
+        return context
+
+    def downscaled(self, max_side):
+        """
+        The image resized so that its longest side is no greater than
+        max_side (see preprocessing.downscale), made from the reduced
+        decode where there is one so the full image isn't decoded.
+        """
+        source = self._bgr if self._reduced is None else self._reduced
+        return preprocessing.downscale(source, max_side)
+
+    # ~~ Properties ~~ #
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def name(self):
+        if self._path is None:
+            raise ValueError(
+                "Image has no file path to name its outputs after.")
+        return self._path.stem
+
+    @property
+    def shape(self):
+        return self._shape
+
+    @property
+    def bgr(self):
+        if self._bgr is None:
+            start = time.perf_counter()
+            bgr = _imread(self._path)
+            if bgr.shape[:2] != self._shape[:2]:
+                # header and decoder disagree; trust the decoder
+                self._shape = bgr.shape
+            self._bgr = bgr
+            self._reduced = None
+            self.timings["full_decode"] = time.perf_counter() - start
+        return self._bgr
+
+    @property
+    def gray(self):
+        if self._gray is None:
+            self._gray = cv2.cvtColor(self.bgr, cv2.COLOR_BGR2GRAY)
+        return self._gray
+
+    @property
+    def rgb(self):
+        if self._rgb is None:
+            self._rgb = cv2.cvtColor(self.bgr, cv2.COLOR_BGR2RGB)
+        return self._rgb
+
+    @property
+    def pil(self):
+        if self._pil is None:
+            rgb = self.rgb
+            self._pil = Image.frombuffer("RGB", (rgb.shape[1], rgb.shape[0]),
+                                         rgb, "raw", "RGB", 0, 1)
+        return self._pil
+
+
+def _to_bgr(image):
+    if image.ndim == 2:
+        image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+    return image
+
+
+def _imread(path, flags=cv2.IMREAD_COLOR):
+    """
+    cv2.imread that raises ValueError if the image can't be loaded.
+    """
+    image = cv2.imread(str(Path(path).resolve()), flags)
+    if image is None:
+        raise ValueError("Invalid image file path.")
+    return image
+
+
+def read_shape(path):
+    """
+    Reads the (i,j,3) shape of the image at path from its header,
+    accounting for EXIF rotation as cv2.imread does, without decoding
+    it. Returns None if the header can't be read.
+    """
+    try:
+        with Image.open(str(path)) as pil_image:
+            cols, rows = pil_image.size
+            if hasattr(pil_image, "getexif"):
+                exif = pil_image.getexif()
+            else:
+                # Pillow < 6
+                exif = getattr(pil_image, "_getexif", lambda: None)() or {}
+            orientation = exif.get(0x0112, 1)
+    except (IOError, SyntaxError):
+        return None
+    if orientation in _TRANSPOSED_ORIENTATIONS:
+        rows, cols = cols, rows
+    return rows, cols, 3
+
+
+def as_context(image):
+    """
+    Returns image as an ImageContext, decoding it if given a path. A
+    context built from an array has no path (or name), so it can't be
+    written out with Box.write_to_file or write_boxes.
+    """
+    if isinstance(image, ImageContext):
+        return image
+    if isinstance(image, np.ndarray):
+        return ImageContext(image)
+    return ImageContext.load(image)
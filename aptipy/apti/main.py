@@ -11,57 +11,121 @@ Licensed under the terms of the GNU General Public License
 ## ==== Imports ==== ##
 # std imports
 import cv2
+import time
+import queue
+import threading
 import numpy as np
 import argparse
 from pathlib import Path
+from multiprocessing import Pool
+from concurrent.futures import ThreadPoolExecutor
 # module imports
-from ..apti import preprocessing, bounding_box, box_factory
+from ..apti import preprocessing, bounding_box, box_factory, shared_map, utilities
+from ..apti import saliency_cache, image_context
 from ..apti import directions_factory as df
 from ..scrape_headlines.requester import Requester
 from ..apti.text import Text
 
 
-def main(img_path, savefolder):
+FONT_PATH = Path(
+    r'../salience-in-photographs/aptipy/assets/BBCReith/BBCReithSans_Bd.ttf')
+
+
+def get_save_path(savefolder):
     """
-    main function for running the minimisation on a test image
+    Resolves the output folder. If not specified, the working directory
+    is used.
     """
-    ## save path ##
-    # check if optional savepath has been given
-    # if not specified, the root directory is used
     if savefolder is not None:
         parent_save_path = Path.home() / Path(savefolder)
         print(parent_save_path)
     else:
         parent_save_path = Path.cwd()
+    return parent_save_path
+
+
+def load_image(img_path, working_side=None):
+    """
+    Resolves and decodes an image. The returned ImageContext is shared
+    by every later stage, so the file is only decoded once. If
+    working_side is given, large JPEGs are decoded at a reduced scale
+    and only decoded at full size when the headline is rendered.
 
+    Returns:
+        ImageContext
+    Raises:
+        ValueError: if the image can't be found or loaded.
+    """
     ## image path ##
     raw_img_path = Path.home() / Path(img_path)
-    # check that image exists
-    if not raw_img_path.is_file():
-        raise ValueError("Invalid image file path. File does not exist.")
-
-    # ==== load & process image ==== #
-    raw_img = cv2.imread(str(raw_img_path.resolve()))
-    if raw_img is not None:
-        pass
-    else:
-        raise ValueError("Invalid image file path.")
+
+    # ==== load image ==== #
+    return image_context.ImageContext.load(raw_img_path, working_side)
+
+
+def print_timings(timings_list):
+    """
+    Prints the mean time per image spent in each stage, from a list of
+    ImageContext.timings dicts. "write" includes "full_decode".
+    """
+    totals = dict()
+    for timings in timings_list:
+        for stage, seconds in timings.items():
+            totals[stage] = totals.get(stage, 0) + seconds
+    stages = [
+        "decode", "saliency", "prepare", "search", "full_decode", "write"
+    ]
+    print("Mean stage timings (s/image):", ", ".join(
+        stage + " " + str(round(totals[stage] / len(timings_list), 3))
+        for stage in stages if stage in totals))
+
+
+def prepare_image(img_path, headline_server, image=None, working_side=None):
+    """
+    Loads an image (unless already decoded and passed as image, an
+    ImageContext), computes its saliency map, picks and measures a
+    headline and generates the starting boxes.
+
+    If working_side is given, the saliency map and the box search use a
+    copy of the image downscaled to that longest side (decoded at reduced
+    scale if possible). Boxes are mapped back to the original image when
+    they are written.
+
+    Returns:
+        image: ImageContext of the image.
+        text_ctx: Text object for the headline.
+        box_list: list of starting Box objects, one per anchor.
+        directions: list of direction arrays matching box_list.
+    Raises:
+        ValueError: if the image can't be found or loaded.
+    """
+    if image is None:
+        image = load_image(img_path, working_side)
     # process image
-    s_map = preprocessing.generate_saliency_map(raw_img, to_display=True)
+    start = time.perf_counter()
+    if working_side is None:
+        s_map = preprocessing.generate_saliency_map(image.bgr, to_display=True)
+    else:
+        s_map = preprocessing.generate_saliency_map(
+            image.downscaled(working_side),
+            to_display=True,
+            max_side=working_side)
+    image.timings["saliency"] = time.perf_counter() - start
+    start = time.perf_counter()
 
     # ==== get a headline and measure ==== #
-    headline_server = Requester()
     headline_raw, headline_idx = headline_server.get()
     print("HL ", headline_idx, ": ", headline_raw)
 
-    fontpath = Path(
-        r'../salience-in-photographs/aptipy/assets/BBCReith/BBCReithSans_Bd.ttf'
-    )
-    text_ctx = Text(headline_raw, fontpath.resolve())
-    text_ctx.rescale_font_size(s_map.shape)
+    text_ctx = Text(headline_raw, FONT_PATH.resolve())
+    text_ctx.rescale_font_size(image.shape)
 
     # ==== generate boxes and directions ==== #
-    factory = box_factory.BoxFactory(s_map, headline=text_ctx)
+    # constraints come pre-measured from the headline server's index
+    constraints = headline_server.constraints(
+        headline_idx, text_ctx.font_path, text_ctx.font_size)
+    factory = box_factory.BoxFactory(
+        s_map, headline=text_ctx, image=image, constraints=constraints)
     #factory = box_factory.BoxFactory(s_map)
     # generate requests for the factory
     box_init_size = 0.3  # this can be expressed as an ndarray or as a fraction of image size
@@ -91,8 +155,34 @@ def main(img_path, savefolder):
         df.top_anchored(),
         df.bottom_anchored()
     ]
+    image.timings["prepare"] = time.perf_counter() - start
+    return image, text_ctx, box_list, directions
+
+
+def main(img_path,
+         savefolder,
+         headline_server=None,
+         pool=None,
+         working_side=None):
+    """
+    main function for running the minimisation on a test image
+
+    headline_server (a Requester) and pool (a multiprocessing.Pool) can
+    be passed in to reuse them across images; see run_batch.
+    working_side is passed to prepare_image.
 
-    box_list = box_factory.minimise_boxes(box_list, directions)
+    Returns:
+        dict of seconds spent in each stage (see print_timings).
+    """
+    parent_save_path = get_save_path(savefolder)
+    if headline_server is None:
+        headline_server = Requester()
+    image, text_ctx, box_list, directions = prepare_image(
+        img_path, headline_server, working_side=working_side)
+
+    start = time.perf_counter()
+    box_list = box_factory.minimise_boxes(box_list, directions, pool=pool)
+    image.timings["search"] = time.perf_counter() - start
     """
     for box in box_list:
         img = box.overlay_box(raw_img)
@@ -101,8 +191,10 @@ def main(img_path, savefolder):
     """
 
     # write boxes
+    start = time.perf_counter()
     box_factory.write_boxes(
-        box_list, parent_save_path, raw_img_path, headline=text_ctx)
+        box_list, parent_save_path, image, headline=text_ctx)
+    image.timings["write"] = time.perf_counter() - start
     """
    
     # minimise salience
@@ -113,6 +205,351 @@ def main(img_path, savefolder):
         '../mphys-testing/salience-in-photographs/images/output')
     cv2.waitKey(0)
     """
+    return image.timings
+
+
+def run_batch(img_paths, savefolder, working_side=None):
+    """
+    Runs main on each image in img_paths with one headline store and one
+    worker pool for the whole run, rather than one per image. Workers are
+    initialised once when the pool opens.
+
+    Returns:
+        (number of images processed, elapsed seconds)
+    """
+    headline_server = Requester()
+    n_images = 0
+    timings_list = []
+    start = time.perf_counter()
+    with Pool(processes=box_factory.default_num_workers(),
+              initializer=box_factory.init_worker) as pool:
+        for img_path in img_paths:
+            timings_list.append(
+                main(img_path, savefolder, headline_server=headline_server,
+                     pool=pool, working_side=working_side))
+            n_images += 1
+    elapsed = time.perf_counter() - start
+    print("Processed", n_images, "images in", round(elapsed, 2), "s (",
+          round(n_images / elapsed, 2), "images/s )")
+    if timings_list:
+        print_timings(timings_list)
+    return n_images, elapsed
+
+
+def _scheduled_task(task):
+    """
+    Worker side of run_scheduled: one (image, anchor) descent.
+    """
+    image_index, box_index, args = task
+    return image_index, box_index, box_factory.minimise_shared(*args)
+
+
+def run_scheduled(img_paths,
+                  savefolder,
+                  max_in_flight=None,
+                  step_size=5,
+                  n_iterations=10000,
+                  search="descent",
+                  working_side=None,
+                  search_options=None):
+    """
+    Runs a folder as one flat queue of (image, anchor) descents. Tasks
+    are handed out one at a time as workers free up (imap_unordered), so
+    a slow anchor no longer holds up the rest of its image or the next
+    image. Each image is written as soon as all of its anchors are done.
+
+    Images are prepared (loaded, saliency mapped and measured) on the
+    pool's task thread, which reads ahead of the workers as far as it
+    can: preparation is only held back by max_in_flight, the most images
+    between preparation and writing at once, which bounds memory use.
+
+    step_size, n_iterations, search and search_options are passed to
+    bounding_box.minimise_cost for every anchor.
+
+    Returns:
+        (number of images processed, elapsed seconds)
+    """
+    parent_save_path = get_save_path(savefolder)
+    headline_server = Requester()
+    num_workers = box_factory.default_num_workers()
+    if max_in_flight is None:
+        max_in_flight = 2 * num_workers
+    in_flight = threading.BoundedSemaphore(max_in_flight)
+    # image_index -> Bunch of the image's state until it is written
+    jobs = dict()
+
+    # set once the run ends, successfully or not
+    stopped = threading.Event()
+
+    def tasks():
+        # consumed by the pool's task thread
+        for image_index, img_path in enumerate(img_paths):
+            in_flight.acquire()
+            if stopped.is_set():
+                return
+            image, text_ctx, box_list, directions = prepare_image(
+                img_path, headline_server, working_side=working_side)
+            shared = shared_map.SharedMap(box_list[0].s_map,
+                                          box_list[0].engine)
+            jobs[image_index] = utilities.Bunch(
+                image=image,
+                text_ctx=text_ctx,
+                box_list=box_list,
+                shared=shared,
+                results=[None] * len(box_list),
+                n_remaining=len(box_list))
+            if stopped.is_set():
+                # the run ended while this image was being prepared
+                shared.close()
+                return
+            for box_index, box in enumerate(box_list):
+                yield image_index, box_index, (
+                    shared.handle, box.rect, box.min_size, box.min_area,
+                    directions[box_index], step_size, n_iterations, search,
+                    search_options)
+
+    n_images = 0
+    timings_list = []
+    start = time.perf_counter()
+    try:
+        with Pool(processes=num_workers,
+                  initializer=box_factory.init_worker) as pool:
+            try:
+                for image_index, box_index, result in pool.imap_unordered(
+                        _scheduled_task, tasks()):
+                    job = jobs[image_index]
+                    job.results[box_index] = result
+                    job.n_remaining -= 1
+                    if job.n_remaining > 0:
+                        continue
+                    # all anchors done: finalise the image
+                    job.shared.close()
+                    box_list = [
+                        box_factory.box_from_result(box, result)
+                        for box, result in zip(job.box_list, job.results)
+                    ]
+                    write_start = time.perf_counter()
+                    box_factory.write_boxes(
+                        box_list,
+                        parent_save_path,
+                        job.image,
+                        headline=job.text_ctx)
+                    job.image.timings["write"] = \
+                        time.perf_counter() - write_start
+                    timings_list.append(job.image.timings)
+                    del jobs[image_index]
+                    in_flight.release()
+                    n_images += 1
+            finally:
+                stopped.set()
+                # wake the task thread if it is waiting for a free slot,
+                # so that the pool can shut down
+                for _ in range(max_in_flight):
+                    try:
+                        in_flight.release()
+                    except ValueError:
+                        break
+    finally:
+        # an image left unfinished (a worker raised, or the loop exited
+        # early) would otherwise leak its temporary files. The pool has
+        # been terminated by now, so no worker still maps them.
+        for job in list(jobs.values()):
+            job.shared.close()
+    elapsed = time.perf_counter() - start
+    print("Processed", n_images, "images in", round(elapsed, 2), "s (",
+          round(n_images / elapsed, 2), "images/s )")
+    if timings_list:
+        print_timings(timings_list)
+    return n_images, elapsed
+
+
+# marks the end of a pipeline queue
+_END = object()
+
+
+def _pipeline_stage(func, in_queue, out_queue, n_upstream=1, stop=None):
+    """
+    Thread body for one pipeline stage: applies func to each item from
+    in_queue and puts the result on out_queue. Exceptions are passed
+    downstream in place of a result. Ends once all n_upstream producers
+    have sent _END. Once the stop event is set, items are taken from
+    in_queue and dropped, so that upstream stages never block on a full
+    queue, until _END is reached.
+    """
+    n_ended = 0
+    while n_ended < n_upstream:
+        item = in_queue.get()
+        if item is _END:
+            n_ended += 1
+            continue
+        if stop is not None and stop.is_set():
+            continue
+        if not isinstance(item, Exception):
+            try:
+                item = func(item)
+            except Exception as error:
+                item = error
+        out_queue.put(item)
+    out_queue.put(_END)
+
+
+def run_pipelined(img_paths,
+                  savefolder,
+                  queue_size=4,
+                  n_io_threads=2,
+                  backend="pool",
+                  working_side=None):
+    """
+    Runs a folder as a streaming pipeline so that decoding, saliency,
+    search and writing of different images overlap:
+
+        decode (n_io_threads threads)
+          -> saliency & measurement (1 thread)
+          -> search (this thread, on a process pool or batched in-process)
+          -> write (n_io_threads threads)
+
+    Decoding and encoding are mostly done in OpenCV/PIL code that
+    releases the GIL, so they proceed while the search runs. Stages are
+    joined by queues of at most queue_size images and at most
+    queue_size writes are outstanding, so memory stays flat however
+    large the folder is.
+
+    If any stage raises, the decode and prepare stages are stopped and
+    their queues drained before the exception is re-raised. A failed
+    write is raised as soon as it is seen.
+
+    Returns:
+        (number of images processed, elapsed seconds)
+    Raises:
+        The first exception raised by any stage.
+    """
+    parent_save_path = get_save_path(savefolder)
+    headline_server = Requester()
+    # set when the search stage fails, to wind down the earlier stages
+    stop = threading.Event()
+    path_queue = queue.Queue()
+    decoded_queue = queue.Queue(maxsize=queue_size)
+    prepared_queue = queue.Queue(maxsize=queue_size)
+    for img_path in img_paths:
+        path_queue.put(img_path)
+    for _ in range(n_io_threads):
+        path_queue.put(_END)
+
+    # decode & prepare stages
+    def decode(img_path):
+        return img_path, load_image(img_path, working_side)
+
+    def prepare(item):
+        img_path, image = item
+        return prepare_image(
+            img_path, headline_server, image=image,
+            working_side=working_side)
+
+    threads = [
+        threading.Thread(
+            target=_pipeline_stage,
+            args=(decode, path_queue, decoded_queue, 1, stop),
+            daemon=True) for _ in range(n_io_threads)
+    ]
+    threads.append(
+        threading.Thread(
+            target=_pipeline_stage,
+            args=(prepare, decoded_queue, prepared_queue, n_io_threads,
+                  stop),
+            daemon=True))
+    for thread in threads:
+        thread.start()
+
+    # write stage: a bounded number of outstanding writes
+    write_slots = threading.BoundedSemaphore(queue_size)
+    writes = []
+
+    def write(box_list, image, text_ctx):
+        write_start = time.perf_counter()
+        box_factory.write_boxes(
+            box_list, parent_save_path, image, headline=text_ctx)
+        image.timings["write"] = time.perf_counter() - write_start
+        return image.timings
+
+    def collect(wait=False):
+        # timings of the finished writes; raises a failed write's error
+        pending = []
+        for future in writes:
+            if wait or future.done():
+                timings_list.append(future.result())
+            else:
+                pending.append(future)
+        writes[:] = pending
+
+    n_images = 0
+    timings_list = []
+    ended = False
+    start = time.perf_counter()
+    pool = None
+    if backend == "pool":
+        pool = Pool(processes=box_factory.default_num_workers(),
+                    initializer=box_factory.init_worker)
+    try:
+        with ThreadPoolExecutor(max_workers=n_io_threads) as writer:
+            # search stage
+            while True:
+                item = prepared_queue.get()
+                if item is _END:
+                    ended = True
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                image, text_ctx, box_list, directions = item
+                search_start = time.perf_counter()
+                box_list = box_factory.minimise_boxes(
+                    box_list, directions, backend=backend, pool=pool)
+                image.timings["search"] = time.perf_counter() - search_start
+                write_slots.acquire()
+                collect()
+                future = writer.submit(write, box_list, image, text_ctx)
+                # freed once the future is done, so collect sees it
+                future.add_done_callback(lambda _: write_slots.release())
+                writes.append(future)
+                n_images += 1
+            collect(wait=True)
+    except BaseException:
+        stop.set()
+        # unblock the earlier stages so that their threads finish
+        while not ended:
+            ended = prepared_queue.get() is _END
+        raise
+    finally:
+        if pool is not None:
+            pool.terminate()
+    elapsed = time.perf_counter() - start
+    print("Processed", n_images, "images in", round(elapsed, 2), "s (",
+          round(n_images / elapsed, 2), "images/s )")
+    if timings_list:
+        print_timings(timings_list)
+    return n_images, elapsed
+
+
+def prewarm_fonts(img_paths):
+    """
+    Reads the fonts into the process-wide font cache and loads the
+    headline font in the size each image's headline will be set in
+    (see Text.rescale_font_size), as read from the image headers, so
+    that no font is parsed once the run has started.
+    """
+    utilities.FONT_CACHE.prewarm()
+    font_path = FONT_PATH.resolve()
+    if not font_path.is_file():
+        return
+    text_ctx = Text("", font_path)
+    font_sizes = {text_ctx.font_size}
+    for img_path in img_paths:
+        shape = image_context.read_shape(Path.home() / img_path)
+        if shape is not None:
+            text_ctx = Text("", font_path)
+            text_ctx.rescale_font_size(shape)
+            font_sizes.add(text_ctx.font_size)
+    for font_size in sorted(font_sizes):
+        utilities.FONT_CACHE.get(font_path, font_size)
 
 
 def run_on_file():
@@ -124,12 +561,22 @@ def run_on_file():
     parser.add_argument(
         "-f", help="path to output",
         type=str)  # this argument is optional (defaults to NoneType)
+    parser.add_argument(
+        "-c", help="path to saliency map cache", type=str)  # optional
+    parser.add_argument(
+        "-w",
+        help="working resolution: longest side in pixels of the image "
+        "used for the saliency map and box search",
+        type=int)  # optional
 
     # grab args
     args = parser.parse_args()
+    prewarm_fonts([args.img_path])
+    if args.c is not None:
+        saliency_cache.enable(Path.home() / Path(args.c))
 
     # run main
-    main(args.img_path, args.f)
+    main(args.img_path, args.f, working_side=args.w)
 
 
 def run_on_folder():
@@ -137,12 +584,35 @@ def run_on_folder():
     parser.add_argument("dir", help="path to image directory", type=str)
     parser.add_argument(
         "-f", help="path to output directory", type=str)  # optional
+    parser.add_argument(
+        "-m",
+        help="scheduling: one pool task per anchor across the whole "
+        "folder (scheduled), one image at a time (batch), or overlapping "
+        "decode/search/write stages (pipelined)",
+        choices=["scheduled", "batch", "pipelined"],
+        default="scheduled")  # optional
+    parser.add_argument(
+        "-c", help="path to saliency map cache", type=str)  # optional
+    parser.add_argument(
+        "-w",
+        help="working resolution: longest side in pixels of the image "
+        "used for the saliency map and box search",
+        type=int)  # optional
 
     args = parser.parse_args()
+    if args.c is not None:
+        saliency_cache.enable(Path.home() / Path(args.c))
     # get files in dir
     img_dir = Path.home() / Path(args.dir)
-    for img in img_dir.iterdir():
-        main(img, args.f)
+    prewarm_fonts(sorted(img_dir.iterdir()))
+    if args.m == "batch":
+        run_batch(sorted(img_dir.iterdir()), args.f, working_side=args.w)
+    elif args.m == "pipelined":
+        run_pipelined(
+            sorted(img_dir.iterdir()), args.f, working_side=args.w)
+    else:
+        run_scheduled(
+            sorted(img_dir.iterdir()), args.f, working_side=args.w)
 
 
 if __name__ == "__main__":
@@ -13,11 +13,35 @@ Licensed under the terms of the GNU General Public License
 
 import cv2
 import sys
+import numpy as np
 import matplotlib.pyplot as plt
 
-def generate_saliency_map(image, threshold_floor=None, to_display=False):
+from ..apti import saliency_backends, saliency_cache
+
+
+def downscale(image, max_side):
+    """
+    Resizes image (with area averaging) so that its longest side is no
+    greater than max_side. Smaller images are returned unchanged.
+    """
+    longest_side = max(image.shape[:2])
+    if longest_side <= max_side:
+        return image
+    scale = max_side / longest_side
+    size = (max(1, int(round(image.shape[1] * scale))),
+            max(1, int(round(image.shape[0] * scale))))
+    return cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+
+
+def generate_saliency_map(image,
+                          threshold_floor=None,
+                          to_display=False,
+                          cache=None,
+                          max_side=None,
+                          backend=None):
     """
-    Calculates the spectral saliency of the input image
+    Calculates the saliency of the input image. The spectral residual
+    is used unless another backend is given.
 
     Args:
         image: loaded using scikit-image/opencv
@@ -25,31 +49,89 @@ def generate_saliency_map(image, threshold_floor=None, to_display=False):
                          Any areas below this threshold will be set to 0 saliency
         to_display: optional flag. When enabled, rescales saliency values so they
                     can be displayed (max of 255)
+        cache: optional saliency_cache.SaliencyCache. Defaults to the
+               process-wide cache, if one is enabled. False bypasses
+               caching.
+        max_side: optional working resolution. If given, the map is
+                  computed on a copy of the image downscaled so that its
+                  longest side is max_side, and is returned at that size.
+                  The spectral residual is low-frequency, so little is
+                  lost. Box.image_coords maps boxes back to the image.
+        backend: optional saliency backend: a name registered in
+                 saliency_backends, a SaliencyBackend, or a callable
+                 taking an image and returning a float map in [0, 1].
     Returns:
-        Spectral saliency of the input image as a numpy matrix
+        Saliency of the input image as a numpy matrix. Maps
+        served from the cache are read-only memory maps.
 
     Raises:
+        ValueError: if backend is an unknown name.
     """
-    # initialise saliency detector object
-    saliency_detector = cv2.saliency.StaticSaliencySpectralResidual_create()
-    # compute saliency map
-    __, saliency_map = saliency_detector.computeSaliency(image)
+    backend = saliency_backends.get_backend(backend)
+    if cache is None:
+        cache = saliency_cache.default_cache()
+    if cache:
+        key = cache.key(
+            image,
+            threshold_floor=threshold_floor,
+            to_display=to_display,
+            max_side=max_side,
+            backend=backend.name)
+        saliency_map = cache.get(key)
+        if saliency_map is None:
+            saliency_map = generate_saliency_map(
+                image, threshold_floor, to_display, False, max_side, backend)
+            cache.put(key, saliency_map)
+        return saliency_map
+
+    if max_side is not None:
+        image = downscale(image, max_side)
+
+    # compute saliency map (the backend reuses its detector)
+    saliency_map = backend.compute(image)
+    floor, ceiling = backend.value_range
 
     # check if rescaling is wanted
     if to_display:
-        saliency_map = (saliency_map * 255).astype("uint8")
+        # skip the conversion if the backend already produces 8 bit maps
+        if backend.dtype != np.uint8 or (floor, ceiling) != (0, 255):
+            saliency_map = ((saliency_map - floor) *
+                            (255 / (ceiling - floor))).astype("uint8")
         if threshold_floor is not None:
             threshold_floor = threshold_floor * 255
         threshold_ceiling = 255
     else:
-        threshold_ceiling = 1
+        if threshold_floor is not None:
+            threshold_floor = floor + threshold_floor * (ceiling - floor)
+        threshold_ceiling = ceiling
     # check if thresholding is wanted
     if threshold_floor is not None:
         saliency_map = cv2.threshold(saliency_map, threshold_floor, threshold_ceiling,
                                  cv2.THRESH_BINARY | cv2.THRESH_OTSU)[1]
 
     return saliency_map
-        
+
+
+def build_pyramid(saliency_map, min_side=64):
+    """
+    Builds a Gaussian pyramid from a saliency map (as returned by
+    generate_saliency_map), halving the resolution until the longest
+    side is no greater than min_side.
+
+    Args:
+        saliency_map: 2D saliency map.
+        min_side: longest side of the coarsest level, in pixels.
+    Returns:
+        List of maps ordered from the finest (saliency_map itself) to
+        the coarsest.
+
+    Raises:
+    """
+    pyramid = [saliency_map]
+    while max(pyramid[-1].shape[:2]) > min_side:
+        pyramid.append(cv2.pyrDown(pyramid[-1]))
+    return pyramid
+
 
 if __name__ == "__main__":
 
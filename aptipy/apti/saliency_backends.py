@@ -0,0 +1,252 @@
+"""
+saliency_backends.py
+
+Registry of the saliency algorithms that preprocessing can use to
+compute a saliency map. Each backend declares the dtype and value range
+of the maps it returns, so callers only convert when they need to.
+Stateful detectors (e.g. the OpenCV saliency objects) are built once per
+process and reused for every image.
+
+Built-in backends:
+
+    spectral_residual : OpenCV's spectral residual (Hou & Zhang). Default.
+    fine_grained      : OpenCV's fine grained saliency.
+    numpy_spectral_residual : the spectral residual in NumPy. Matches
+                        spectral_residual to within 1e-4 (on maps in
+                        [0, 1]; see tests/test_saliency_backends.py).
+
+Copyright © 2018, Naim Sen
+Licensed under the terms of the GNU General Public License
+<https://www.gnu.org/licenses/gpl-3.0.en.html>
+"""
+
+# std imports
+import os
+
+import numpy as np
+import cv2
+
+DEFAULT_BACKEND = "spectral_residual"
+
+# side of the square thumbnail the spectral residual is computed on,
+# as in OpenCV's StaticSaliencySpectralResidual
+SPECTRAL_RESIDUAL_SIDE = 64
+
+_BACKENDS = dict()
+
+
+class SaliencyBackend(object):
+    """
+    A named saliency algorithm.
+
+    #Properties
+
+        name        : name the backend is registered under.
+        dtype       : numpy dtype of the maps returned by compute.
+        value_range : (min, max) of the values returned by compute.
+        detector    : the process's detector instance, or None if the
+                      backend doesn't use one.
+    """
+
+    def __init__(self,
+                 name,
+                 compute,
+                 dtype=np.float32,
+                 value_range=(0.0, 1.0),
+                 detector_factory=None):
+        """
+        Args:
+            name: backend name.
+            compute: callable returning a 2D saliency map the size of
+                     the image. Called as compute(image), or as
+                     compute(image, detector) if detector_factory is set.
+            dtype: dtype of the maps compute returns.
+            value_range: (min, max) of the maps compute returns.
+            detector_factory: optional callable building the detector
+                              passed to compute.
+        """
+        self.name = name
+        self.dtype = np.dtype(dtype)
+        self.value_range = tuple(value_range)
+        self._compute = compute
+        self._detector_factory = detector_factory
+        self._detector = None
+        self._detector_pid = None
+
+    def __repr__(self):
+        return "SaliencyBackend({!r})".format(self.name)
+
+    @property
+    def detector(self):
+        if self._detector_factory is None:
+            return None
+        # rebuild in forked workers rather than share the parent's
+        if self._detector is None or self._detector_pid != os.getpid():
+            self._detector = self._detector_factory()
+            self._detector_pid = os.getpid()
+        return self._detector
+
+    def compute(self, image):
+        """
+        Computes the saliency map of image (BGR or grayscale).
+        """
+        if self._detector_factory is None:
+            return self._compute(image)
+        return self._compute(image, self.detector)
+
+
+def register(name,
+             compute,
+             dtype=np.float32,
+             value_range=(0.0, 1.0),
+             detector_factory=None):
+    """
+    Registers a backend under name, replacing any backend already
+    registered with that name. See SaliencyBackend for the arguments.
+
+    Returns:
+        The SaliencyBackend.
+    """
+    backend = SaliencyBackend(name, compute, dtype, value_range,
+                              detector_factory)
+    _BACKENDS[name] = backend
+    return backend
+
+
+def get_backend(backend=None):
+    """
+    Resolves backend to a SaliencyBackend.
+
+    Args:
+        backend: a registered name, a SaliencyBackend, or a callable
+                 taking an image and returning a float map in [0, 1].
+                 A callable is named after its module and qualified
+                 name, which the saliency cache keys on, so it must be
+                 a module-level function; wrap a lambda or a nested
+                 function in a SaliencyBackend with a unique name.
+                 Defaults to DEFAULT_BACKEND.
+    Returns:
+        SaliencyBackend
+    Raises:
+        ValueError: if backend is an unknown name, or a callable without
+                    a unique name.
+    """
+    if backend is None:
+        backend = DEFAULT_BACKEND
+    if isinstance(backend, SaliencyBackend):
+        return backend
+    if callable(backend):
+        qualname = getattr(backend, "__qualname__", "<lambda>")
+        if "<lambda>" in qualname or "<locals>" in qualname:
+            raise ValueError(
+                "Saliency backend {!r} has no unique name. Pass a "
+                "SaliencyBackend with a name instead.".format(backend))
+        name = "{}.{}".format(backend.__module__, qualname)
+        return SaliencyBackend(name, backend)
+    try:
+        return _BACKENDS[backend]
+    except KeyError:
+        raise ValueError("Unknown saliency backend: {}. Available: {}".format(
+            backend, ", ".join(sorted(_BACKENDS))))
+
+
+def available():
+    """
+    Names of the registered backends.
+    """
+    return sorted(_BACKENDS)
+
+
+# ~~ OpenCV backends ~~ #
+def _opencv_compute(image, detector):
+    __, saliency_map = detector.computeSaliency(image)
+    return saliency_map
+
+
+# ~~ NumPy spectral residual ~~ #
+def _reflect_pad(array, width):
+    """
+    Pads the last two axes in the same way as OpenCV's BORDER_DEFAULT.
+    """
+    pad = [(0, 0)] * (array.ndim - 2) + [(width, width)] * 2
+    return np.pad(array, pad, mode="reflect")
+
+
+def _separable_filter(array, kernel):
+    """
+    Convolves the last two axes with the outer product of kernel with
+    itself (kernel must be of odd length and symmetric).
+    """
+    width = len(kernel) // 2
+    padded = _reflect_pad(array, width)
+    rows, cols = array.shape[-2:]
+    out = sum(weight * padded[..., offset:offset + rows, :]
+              for offset, weight in enumerate(kernel))
+    return sum(weight * out[..., offset:offset + cols]
+               for offset, weight in enumerate(kernel))
+
+
+def _gaussian_kernel(size, sigma):
+    x = np.arange(size) - (size - 1) / 2
+    kernel = np.exp(-x**2 / (2 * sigma**2))
+    return kernel / kernel.sum()
+
+
+def spectral_residual(thumbnails):
+    """
+    Spectral residual saliency (Hou & Zhang) of grayscale thumbnails,
+    following OpenCV's StaticSaliencySpectralResidual step by step: the
+    log amplitude spectrum, log(1 + |F|), minus its 3x3 average is
+    recombined with the phase, inverse transformed, smoothed with a 5x5
+    Gaussian (sigma 8), squared and divided by its maximum.
+
+    Args:
+        thumbnails: (..., h, w) array of grayscale images. Leading axes
+                    are treated as a batch and transformed together.
+    Returns:
+        (..., h, w) float64 array of maps in [0, 1].
+    """
+    spectrum = np.fft.fft2(np.asarray(thumbnails, dtype=np.float64))
+    amplitude = np.abs(spectrum)
+    log_amplitude = np.log1p(amplitude)
+    residual = log_amplitude - _separable_filter(log_amplitude,
+                                                 np.full(3, 1 / 3))
+    # exp(residual) with the original phase (zero where there is none)
+    spectrum = np.exp(residual) * np.divide(
+        spectrum, amplitude, out=np.ones_like(spectrum), where=amplitude > 0)
+    saliency = np.abs(np.fft.ifft2(spectrum))
+    saliency = _separable_filter(saliency, _gaussian_kernel(5, 8))**2
+    peak = saliency.max(axis=(-2, -1), keepdims=True)
+    return np.divide(
+        saliency, peak, out=np.zeros_like(saliency), where=peak > 0)
+
+
+def to_thumbnail(image, side=SPECTRAL_RESIDUAL_SIDE):
+    """
+    Converts a BGR or grayscale image to the square grayscale thumbnail
+    the spectral residual is computed on.
+    """
+    if image.ndim == 3:
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    return cv2.resize(
+        image, (side, side), interpolation=cv2.INTER_LINEAR_EXACT)
+
+
+def numpy_spectral_residual(image):
+    """
+    Saliency map of image computed with spectral_residual, at the size
+    of image. OpenCV is only used to resample.
+    """
+    saliency_map = spectral_residual(to_thumbnail(image)).astype(np.float32)
+    return cv2.resize(saliency_map, (image.shape[1], image.shape[0]))
+
+
+register(
+    "spectral_residual",
+    _opencv_compute,
+    detector_factory=cv2.saliency.StaticSaliencySpectralResidual_create)
+register(
+    "fine_grained",
+    _opencv_compute,
+    detector_factory=cv2.saliency.StaticSaliencyFineGrained_create)
+register("numpy_spectral_residual", numpy_spectral_residual)
@@ -0,0 +1,178 @@
+"""
+saliency_cache.py
+
+Content-addressed on-disk cache of saliency maps. Entries are keyed
+by a hash of the image content and the saliency parameters, and hold
+the map and its summed-area table as .npy files that are memory-mapped
+on load. The cache is bounded in size, evicting the least recently
+used entries first.
+
+The cache is used by preprocessing.generate_saliency_map once enabled,
+either with enable() or by setting the APTI_SALIENCY_CACHE environment
+variable to a directory.
+
+Copyright © 2018, Naim Sen
+Licensed under the terms of the GNU General Public License
+<https://www.gnu.org/licenses/gpl-3.0.en.html>
+"""
+
+# std imports
+import os
+import time
+import hashlib
+import tempfile
+from pathlib import Path
+
+import numpy as np
+
+# module imports
+from ..apti import cost_engine
+
+# process-wide cache used by generate_saliency_map (None if disabled)
+_DEFAULT_CACHE = None
+
+# temporary files older than this (in seconds) were left by a writer
+# that crashed, and are removed by evict
+STALE_TMP_AGE = 3600
+
+
+class SaliencyCache(object):
+    """
+    On-disk saliency map cache.
+
+    #Properties
+
+        directory : where the entries are stored.
+        max_bytes : total size above which entries are evicted.
+        hits      : number of lookups served from the cache.
+        misses    : number of lookups that were not.
+    """
+
+    def __init__(self, directory, max_bytes=2**31):
+        self._directory = Path(directory)
+        self._directory.mkdir(parents=True, exist_ok=True)
+        self._max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def directory(self):
+        return self._directory
+
+    @property
+    def max_bytes(self):
+        return self._max_bytes
+
+    # ~~ Methods ~~ #
+    @staticmethod
+    def key(image, **params):
+        """
+        Hash of the image content (pixels, shape and dtype) and the
+        keyword parameters used to compute the map.
+        """
+        image = np.ascontiguousarray(image)
+        digest = hashlib.sha1()
+        digest.update(str((image.shape, image.dtype.str)).encode())
+        digest.update(repr(sorted(params.items())).encode())
+        digest.update(image.data)
+        return digest.hexdigest()
+
+    def _paths(self, key):
+        return (self._directory / (key + ".smap.npy"),
+                self._directory / (key + ".table.npy"))
+
+    def get(self, key):
+        """
+        Returns the memory-mapped (read-only) saliency map stored under
+        key, or None. The stored summed-area table is registered with
+        cost_engine so that boxes on the map don't rebuild it.
+        """
+        map_path, table_path = self._paths(key)
+        try:
+            s_map = np.load(str(map_path), mmap_mode='r')
+            table = np.load(str(table_path), mmap_mode='r')
+        except (IOError, ValueError):
+            self.misses += 1
+            return None
+        # mark as recently used
+        os.utime(str(map_path))
+        os.utime(str(table_path))
+        cost_engine.register_engine(s_map,
+                                    cost_engine.CostEngine.from_table(table))
+        self.hits += 1
+        return s_map
+
+    def put(self, key, s_map):
+        """
+        Stores s_map and its summed-area table under key, then evicts
+        old entries if the cache is over max_bytes.
+        """
+        engine = cost_engine.get_engine(s_map)
+        for path, array in zip(self._paths(key), (s_map, engine.table)):
+            # write to a temporary file first so that readers never see
+            # a partial entry
+            handle, tmp_path = tempfile.mkstemp(
+                dir=str(self._directory), suffix=".tmp")
+            with os.fdopen(handle, 'wb') as file:
+                np.save(file, array)
+            os.replace(tmp_path, str(path))
+        self.evict()
+
+    def evict(self):
+        """
+        Removes least recently used entries until the cache fits in
+        max_bytes, and temporary files left by crashed writers. Other
+        processes may be evicting or writing at the same time, so files
+        can disappear at any point.
+        """
+        now = time.time()
+        for path in self._directory.glob("*.tmp"):
+            try:
+                if now - path.stat().st_mtime > STALE_TMP_AGE:
+                    path.unlink()
+            except OSError:
+                pass
+        entries = dict()
+        for path in self._directory.glob("*.npy"):
+            key = path.name.split(".")[0]
+            try:
+                stat = path.stat()
+            except OSError:
+                # removed since it was listed
+                continue
+            last_used, size = entries.get(key, (0, 0))
+            entries[key] = (max(last_used, stat.st_mtime), size + stat.st_size)
+        total = sum(size for _, size in entries.values())
+        for key in sorted(entries, key=lambda key: entries[key][0]):
+            if total <= self._max_bytes:
+                break
+            for path in self._paths(key):
+                try:
+                    path.unlink()
+                except OSError:
+                    pass
+            total -= entries[key][1]
+
+
+def enable(directory, max_bytes=2**31):
+    """
+    Enables the process-wide cache used by generate_saliency_map.
+    """
+    global _DEFAULT_CACHE
+    _DEFAULT_CACHE = SaliencyCache(directory, max_bytes)
+    return _DEFAULT_CACHE
+
+
+def disable():
+    global _DEFAULT_CACHE
+    _DEFAULT_CACHE = None
+
+
+def default_cache():
+    """
+    The process-wide cache, or None if caching is disabled. Enabled on
+    first call if APTI_SALIENCY_CACHE is set.
+    """
+    if _DEFAULT_CACHE is None and os.environ.get("APTI_SALIENCY_CACHE"):
+        enable(os.environ["APTI_SALIENCY_CACHE"])
+    return _DEFAULT_CACHE
@@ -0,0 +1,88 @@
+"""
+shared_map.py
+
+Shares a saliency map and its summed-area table with pool workers
+through memory-mapped .npy files, so that a worker receives a small
+handle rather than a pickled copy of the map.
+
+Copyright © 2018, Naim Sen
+Licensed under the terms of the GNU General Public License
+<https://www.gnu.org/licenses/gpl-3.0.en.html>
+"""
+
+# std imports
+import shutil
+import tempfile
+from pathlib import Path
+
+import numpy as np
+
+# module imports
+from ..apti import cost_engine
+
+
+class SharedMap(object):
+    """
+    Writes a saliency map and its summed-area table to a temporary
+    directory. Use as a context manager; the files are removed on exit.
+    Close only once no worker is still running a task on the map.
+
+    #Properties
+
+        handle : picklable (map path, table path) tuple to pass to
+                 workers, which call attach(handle).
+    """
+
+    def __init__(self, s_map, engine=None, directory=None):
+        """
+        Args:
+            s_map: 2D saliency map.
+            engine: CostEngine for s_map (looked up if not given).
+            directory: parent directory for the files (system temp
+                       directory by default).
+        """
+        if engine is None:
+            engine = cost_engine.get_engine(s_map)
+        self._dir = Path(tempfile.mkdtemp(prefix="apti_", dir=directory))
+        map_path = self._dir / "s_map.npy"
+        table_path = self._dir / "table.npy"
+        np.save(str(map_path), s_map)
+        np.save(str(table_path), engine.table)
+        self._handle = (str(map_path), str(table_path))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def handle(self):
+        return self._handle
+
+    def close(self):
+        """
+        Removes the files. Closing again does nothing.
+
+        Raises:
+            OSError: if the files can't be removed, e.g. on Windows while
+                     a process still has them mapped.
+        """
+        if self._dir is None:
+            return
+        shutil.rmtree(str(self._dir))
+        self._dir = None
+
+
+def attach(handle):
+    """
+    Maps the files behind handle into memory (read-only) and returns
+    (s_map, engine). Nothing is kept between calls: the mapping is
+    released once the caller drops both, so a worker never holds on to
+    the files of an image whose anchors are done.
+    """
+    map_path, table_path = handle
+    s_map = np.load(map_path, mmap_mode='r')
+    engine = cost_engine.CostEngine.from_table(
+        np.load(table_path, mmap_mode='r'))
+    return s_map, engine
@@ -12,7 +12,7 @@ Licensed under the terms of the GNU General Public License
 """
 
 from pathlib import PurePath
-from math import sqrt
+from math import sqrt, floor, ceil
 import copy
 import time
 
@@ -21,7 +21,7 @@ import cv2
 from PIL import Image, ImageDraw, ImageFont
 
 from .bounding_box import Box, minimise_cost
-from ..apti import directions_factory, preprocessing, utilities
+from ..apti import directions_factory, preprocessing, utilities, image_context
 
 # TODO: Procedural colour if necessary?
 BBC_YELLOW = (255, 210, 47)
@@ -31,23 +31,62 @@ BBC_GREY = (50, 50, 50)
 # draw transparent box on PIL image
 def composite_draw(xy, RGBA, raw_img):
     """
-    Draws RGBA rectangle given corner coordinates xy
+    Draws RGBA rectangle given corner coordinates xy. Only the region
+    covered by the rectangle is composited, so the cost is proportional
+    to the rectangle rather than the image.
     """
     img = raw_img.convert("RGBA")
 
-    # Make a blank image for the rectangle, initialized to a completely
+    # bounding region of the rectangle (corners inclusive), clipped to
+    # the image
+    (x0, y0), (x1, y1) = xy
+    left = max(int(floor(min(x0, x1))), 0)
+    top = max(int(floor(min(y0, y1))), 0)
+    right = min(int(ceil(max(x0, x1))) + 1, img.size[0])
+    bottom = min(int(ceil(max(y0, y1))) + 1, img.size[1])
+    if right <= left or bottom <= top:
+        return img
+
+    # Make a blank layer for the region, initialized to a completely
     # transparent color.
-    tmp = Image.new('RGBA', img.size, (0, 0, 0, 0))
+    tmp = Image.new('RGBA', (right - left, bottom - top), (0, 0, 0, 0))
 
-    # Create a draw context.
+    # Create a draw context and draw the rectangle relative to the region.
     draw = ImageDraw.Draw(tmp)
-    draw.rectangle(xy, fill=RGBA)
+    draw.rectangle(((x0 - left, y0 - top), (x1 - left, y1 - top)), fill=RGBA)
 
-    # Alpha composite the two images together.
-    img = Image.alpha_composite(img, tmp)
+    # Alpha composite the region in place.
+    img.alpha_composite(tmp, dest=(left, top))
     return img
 
 
+def measure_constraints(headline, font_filename, font_size):
+    """
+    Measures the box a headline needs when set in a font: its height and
+    the width of its longest word (the smallest box it can wrap into),
+    and the area it covers on a single line.
+    Args:
+        headline: headline string.
+        font_filename: path of the font file.
+        font_size: font size in pt.
+    returns:
+        Bunch with
+            min_size: [height, width] in pixels (i,j).
+            area: area of the headline on one line in pixels.
+            word_widths: width of each word in pixels.
+    """
+    metrics = utilities.text_metrics(font_filename, font_size)
+    # measure each word
+    word_widths = [metrics.size(word)[0] for word in headline.split()]
+    min_width = max(word_widths, default=0)
+    # get area
+    line_width, line_height = metrics.size(headline)
+    return utilities.Bunch(
+        min_size=[line_height, min_width],
+        area=line_width * line_height,
+        word_widths=word_widths)
+
+
 class Text(object):
     """
     Text class. Handles all operations with text.
@@ -60,9 +99,12 @@ class Text(object):
                  size_pt=24,
                  alignment='left',
                  colour=BBC_YELLOW,
-                 bg_colour=BBC_GREY):
+                 bg_colour=BBC_GREY,
+                 auto_fit=False):
         """
-        Init function
+        Init function. With auto_fit, draw sets the text in the largest
+        font size that wraps inside the box it is given (see
+        fit_font_size) rather than in the font size.
         """
         # assign variables
         self._raw_text = in_text
@@ -71,6 +113,7 @@ class Text(object):
         self._colour = colour
         self._bg_colour = bg_colour
         self._alignment = alignment
+        self._auto_fit = auto_fit
 
         # check font path has valid extension
         ext = font_path.suffix
@@ -82,6 +125,15 @@ class Text(object):
     def __str__(self):
         return self._raw_text
 
+    # ~~ Properties ~~ #
+    @property
+    def font_path(self):
+        return self._font_path
+
+    @property
+    def font_size(self):
+        return self._font_size
+
     def rescale_font_size(self,
                           original_image_dims,
                           target_image_size=5,
@@ -117,11 +169,10 @@ class Text(object):
 
     def get_text_size(self, text):
         """
-        Passthrough function for PIL.ImageFont.getsize()
+        Passthrough function for PIL.ImageFont.getsize(), cached per font
         """
-        font = ImageFont.truetype(str(self._font_path), self._font_size)
-        size = font.getsize(text)
-        return size
+        metrics = utilities.text_metrics(str(self._font_path), self._font_size)
+        return metrics.size(text)
 
     def get_constraints(self, headline=None):
         """
@@ -129,29 +180,54 @@ class Text(object):
         """
         if headline is None:
             headline = self._raw_text
-        # get height and width limits
-        longest_word = ''
-        lword_x = 0
-        # loop over headline and measure each word
-        for word in headline.split():
-            word_x, word_y = self.get_text_size(word)
-            if word_x > lword_x:
-                # save longest word and it's width
-                longest_word = word
-                lword_x = word_x
-        min_width = lword_x
-        # get area
-        line_width, line_height = self.get_text_size(headline)
-
-        area = line_width * line_height
-        minimum_size = np.array([line_height, min_width])
-
-        return minimum_size, area
+        constraints = measure_constraints(headline, str(self._font_path),
+                                          self._font_size)
+        return np.array(constraints.min_size), constraints.area
+
+    def fit_font_size(self, box_shape, min_size=1, max_size=None):
+        """
+        Largest font size in which the text, wrapped to the box's width,
+        fits inside box_shape (i,j). The size is binary searched, so at
+        most about log2(max_size) layouts are measured, each with a
+        cached font.
+        Args:
+            box_shape: (height, width) of the box in pixels.
+            min_size: smallest font size to consider.
+            max_size: largest font size to consider. Defaults to the box
+                      height, which no line of text can be set in.
+        returns:
+            The font size, or min_size - 1 if the text doesn't fit even
+            in min_size.
+        """
+        height, width = box_shape[0], box_shape[1]
+        if max_size is None:
+            max_size = max(int(height), min_size)
+
+        def fits(font_size):
+            layout = utilities.layout_text_box(
+                (0, 0),
+                self._raw_text,
+                width,
+                font_filename=str(self._font_path),
+                font_size=font_size,
+                place=self._alignment)
+            return layout.size[0] <= width and layout.size[1] <= height
+
+        return utilities.fit_font_size(fits, min_size, max_size)
 
     def draw(self, raw_img, box_tl, box_br, box_shape):
         """
-        Draws text on the image provided given a constraining box shape
+        Draws text on the image provided given a constraining box shape.
+        raw_img is a PIL image or an ImageContext (whose PIL view is used).
         """
+        font_size = self._font_size
+        if self._auto_fit:
+            fitted_size = self.fit_font_size(box_shape)
+            # keep the set size if nothing fits
+            if fitted_size >= 1:
+                font_size = fitted_size
+        if isinstance(raw_img, image_context.ImageContext):
+            raw_img = raw_img.pil
         # account for padding
         padding_size = utilities.estimate_stroke_width(raw_img.size)
 
@@ -170,21 +246,17 @@ class Text(object):
         if box_br[1] > raw_img.size[1] - padding_size:
             text_br[1] = raw_img.size[1] - padding_size - box_shape[1]
 
-        # Write text to duplicate image to get text dimensions
+        # Lay the text out (without drawing) to get text dimensions
         # for scrim.
-        # Make duplicate ImageText context
-        dupe_raw_img = copy.copy(raw_img)
-        dupe_text_writer = utilities.ImageText(dupe_raw_img)
-
-        # write_text_box dims must conform with PIL.ImageText (xy not ij) convention
-        text_xy = dupe_text_writer.write_text_box(
+        # layout dims must conform with PIL.ImageText (xy not ij) convention
+        layout = utilities.layout_text_box(
             (text_tl[1], text_tl[0]),
             self._raw_text,
             box_shape[1],
             font_filename=str(self._font_path),
-            font_size=self._font_size,
-            color=self._colour,
+            font_size=font_size,
             place=self._alignment)
+        text_xy = layout.size
         # add padding
         scrim_tl = (text_tl[1] - padding_size, text_tl[0] - padding_size)
         scrim_br = (text_tl[1] + text_xy[0] + padding_size,
@@ -196,17 +268,12 @@ class Text(object):
         out_img = composite_draw((scrim_tl, scrim_br),
                                  self._bg_colour + (127, ), raw_img)
 
-        # Construct ImageText context
+        # blit the rendered text block, which is rasterised once per
+        # distinct headline, font and wrap width (see text_sprite)
+        sprite = utilities.text_sprite(layout, str(self._font_path),
+                                       font_size, self._colour)
         text_writer = utilities.ImageText(out_img)
-
-        # write_text_box dims must conform with PIL.ImageText (xy not ij) convention
-        text_writer.write_text_box((text_tl[1], text_tl[0]),
-                                   self._raw_text,
-                                   box_shape[1],
-                                   font_filename=str(self._font_path),
-                                   font_size=self._font_size,
-                                   color=self._colour,
-                                   place=self._alignment)
+        text_writer.draw_sprite(sprite, layout.origin)
         return out_img, scrim_tl, scrim_br
 
 
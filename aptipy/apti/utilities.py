@@ -12,10 +12,17 @@ Licensed under the terms of the GNU General Public License
 <https://www.gnu.org/licenses/gpl-3.0.en.html>
 """
 
+import io
 import PIL
 import math
+import threading
+from pathlib import Path
+from collections import OrderedDict
 from PIL import Image, ImageDraw, ImageFont
 
+# fonts shipped with the package
+FONT_DIR = Path(__file__).resolve().parent.parent / "assets" / "BBCReith"
+
 
 class Bunch(object):
     """
@@ -27,6 +34,460 @@ class Bunch(object):
         self.__dict__.update(kwds)
 
 
+class FontCache(object):
+    """
+    Bounded least-recently-used cache of PIL fonts keyed by (font path,
+    size), so that measuring and drawing text doesn't re-parse the font
+    file each time. Font files are read into memory once, so a font
+    loaded at a new size is parsed from memory rather than disk. Counts
+    hits and misses. Thread safe.
+    """
+
+    def __init__(self, maxsize=64):
+        self._maxsize = maxsize
+        self._fonts = OrderedDict()
+        self._metrics = dict()
+        self._files = dict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._fonts)
+
+    def __contains__(self, key):
+        return key in self._fonts
+
+    def get(self, font_filename, font_size):
+        """
+        Returns the font at font_filename in font_size, loading it if it
+        isn't cached.
+        """
+        key = (str(font_filename), font_size)
+        with self._lock:
+            font = self._fonts.get(key)
+            if font is not None:
+                self.hits += 1
+                self._fonts.move_to_end(key)
+                return font
+            self.misses += 1
+            font_bytes = self._files.get(key[0])
+        if font_bytes is None:
+            with open(key[0], "rb") as file:
+                font_bytes = file.read()
+        font = ImageFont.truetype(io.BytesIO(font_bytes), font_size)
+        with self._lock:
+            self._files[key[0]] = font_bytes
+            self._fonts[key] = font
+            if len(self._fonts) > self._maxsize:
+                evicted, __ = self._fonts.popitem(last=False)
+                self._metrics.pop(evicted, None)
+        return font
+
+    def metrics(self, font_filename, font_size):
+        """
+        Returns the TextMetrics for the font at font_filename in
+        font_size. Metrics are kept for as long as the font is cached.
+        """
+        font = self.get(font_filename, font_size)
+        key = (str(font_filename), font_size)
+        with self._lock:
+            metrics = self._metrics.get(key)
+            if metrics is None or metrics.font is not font:
+                metrics = TextMetrics(font)
+                self._metrics[key] = metrics
+        return metrics
+
+    def prewarm(self, font_dir=FONT_DIR, sizes=()):
+        """
+        Reads every .ttf/.otf font in font_dir into memory and loads each
+        of them in sizes.
+        """
+        for font_path in sorted(Path(font_dir).iterdir()):
+            if font_path.suffix not in (".ttf", ".otf"):
+                continue
+            with font_path.open("rb") as file:
+                font_bytes = file.read()
+            with self._lock:
+                self._files[str(font_path)] = font_bytes
+            for font_size in sizes:
+                self.get(font_path, font_size)
+
+    def clear(self):
+        with self._lock:
+            self._fonts.clear()
+            self._metrics.clear()
+            self._files.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+class TextMetrics(object):
+    """
+    Cached text measurements in one font, and greedy line breaking in
+    linear time.
+
+    Each distinct word is measured once, as is the gap (space advance
+    and kerning) between each distinct pair of characters either side of
+    a space. The width of a line of words is then the sum of its word
+    widths plus the gaps between them. Pillow lays text out additively,
+    so this is exact up to the rounding of glyph positions to whole
+    pixels. Line breaks within a pixel or two of the box width are
+    therefore confirmed by measuring the whole line, so the wrapping is
+    always the same as measuring every candidate line would give.
+    """
+
+    # strings kept per font before the cache is cleared
+    maxsize = 4096
+    # lines estimated within this many pixels of the box width are measured
+    tolerance = 2
+
+    def __init__(self, font):
+        self.font = font
+        self._sizes = dict()
+        self._gaps = dict()
+        self.hits = 0
+        self.misses = 0
+
+    def size(self, text):
+        """
+        (width, height) of text, as PIL.ImageFont.getsize. Cached.
+        """
+        size = self._sizes.get(text)
+        if size is None:
+            self.misses += 1
+            if len(self._sizes) >= self.maxsize:
+                self._sizes.clear()
+            size = self.font.getsize(text)
+            self._sizes[text] = size
+        else:
+            self.hits += 1
+        return size
+
+    def gap(self, left_word, right_word):
+        """
+        Width added by joining two words with a space: the space's
+        advance, the kerning either side of it and the bearings of the
+        glyphs next to it. This only depends on the last character of
+        left_word and the first of right_word, so it is measured once
+        per pair of characters.
+        """
+        key = (left_word[-1], right_word[0])
+        gap = self._gaps.get(key)
+        if gap is None:
+            gap = (self.size(left_word + " " + right_word)[0] -
+                   self.size(left_word)[0] - self.size(right_word)[0])
+            self._gaps[key] = gap
+        return gap
+
+    def wrap(self, words, box_width):
+        """
+        Breaks words into lines greedily: each word is added to the
+        current line if the line is then no wider than box_width,
+        otherwise it starts a new line. A word wider than box_width is
+        put on a line of its own.
+
+        Returns:
+            lines: list of lists of words.
+            text_height: height of the last line tried, which
+                         ImageText.write_text_box uses as the line
+                         height.
+        """
+        lines = []
+        line = []
+        # width of the current line
+        width = 0
+        fits = False
+        for word in words:
+            word_width = self.size(word)[0]
+            if line:
+                estimate = width + self.gap(line[-1], word) + word_width
+                if abs(estimate - box_width) <= self.tolerance:
+                    estimate = self.size(" ".join(line + [word]))[0]
+            else:
+                estimate = word_width
+            fits = estimate <= box_width
+            if fits:
+                line.append(word)
+                width = estimate
+            else:
+                lines.append(line)
+                line = [word]
+                width = word_width
+        # the last line tried is the last line, or the one before it
+        # with the last word added
+        text_height = None
+        if line:
+            last_tried = line if fits else lines[-1] + line
+            text_height = self.size(" ".join(last_tried))[1]
+            lines.append(line)
+        return [line for line in lines if line], text_height
+
+
+class SpriteCache(object):
+    """
+    Least-recently-used cache of rendered text blocks (see text_sprite),
+    bounded by the total size of their images in bytes, so that a
+    headline drawn many times is only rasterised once. Counts hits and
+    misses. Thread safe.
+    """
+
+    def __init__(self, max_bytes=64 * 2**20):
+        self._max_bytes = max_bytes
+        self._sprites = OrderedDict()
+        self._lock = threading.Lock()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._sprites)
+
+    def __contains__(self, key):
+        return key in self._sprites
+
+    @property
+    def max_bytes(self):
+        return self._max_bytes
+
+    def get(self, key):
+        """
+        Returns the sprite cached under key, or None.
+        """
+        with self._lock:
+            sprite = self._sprites.get(key)
+            if sprite is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._sprites.move_to_end(key)
+            return sprite
+
+    def put(self, key, sprite):
+        """
+        Caches sprite under key, then evicts the least recently used
+        sprites until the cache fits in max_bytes. A sprite larger than
+        max_bytes is not cached.
+        """
+        if sprite.nbytes > self._max_bytes:
+            return
+        with self._lock:
+            previous = self._sprites.pop(key, None)
+            if previous is not None:
+                self.nbytes -= previous.nbytes
+            self._sprites[key] = sprite
+            self.nbytes += sprite.nbytes
+            while self.nbytes > self._max_bytes:
+                __, evicted = self._sprites.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+
+    def clear(self):
+        with self._lock:
+            self._sprites.clear()
+            self.nbytes = 0
+            self.hits = 0
+            self.misses = 0
+
+
+# process-wide cache used by load_font
+FONT_CACHE = FontCache()
+
+# process-wide cache used by text_sprite
+SPRITE_CACHE = SpriteCache()
+
+
+def load_font(font_filename, font_size):
+    """
+    Loads a truetype font through the process-wide FONT_CACHE.
+    """
+    return FONT_CACHE.get(font_filename, font_size)
+
+
+def text_metrics(font_filename, font_size):
+    """
+    TextMetrics of a font in the process-wide FONT_CACHE.
+    """
+    return FONT_CACHE.metrics(font_filename, font_size)
+
+
+def layout_text_box(xy,
+                    text,
+                    box_width,
+                    font_filename,
+                    font_size=11,
+                    place='left',
+                    justify_last_line=False):
+    """
+    Lays text out in a box of box_width at xy without drawing it, as
+    ImageText.write_text_box would draw it.
+
+    Returns:
+        Bunch with
+            runs: list of ((x, y), text) pieces to draw, in order.
+            size: (width, height) of the text block, as returned by
+                  write_text_box.
+            origin, text, box_width, place: the arguments it was laid
+                  out from.
+    """
+    # unpack position tuple
+    x, y = xy
+    words = text.split()  # list of all words
+    # wrap greedily, measuring each word (and word pair) once
+    metrics = text_metrics(font_filename, font_size)
+    lines, text_height = metrics.wrap(words, box_width)
+    # add spaces to word endings
+    lines = [' '.join(line) for line in lines]
+    runs = []
+    height = y
+    width = 0
+    # loop over lines and place them (account for alignment)
+    for index, line in enumerate(lines):
+        line_width = metrics.size(line)[0]
+        # left aligned
+        if place == 'left':
+            runs.append(((x, height), line))
+        # right aligned
+        elif place == 'right':
+            x_left = x + box_width - line_width
+            runs.append(((x_left, height), line))
+        # center aligned
+        elif place == 'center':
+            x_left = int(x + ((box_width - line_width) / 2))
+            runs.append(((x_left, height), line))
+        # justified
+        elif place == 'justify':
+            words = line.split()
+            if (index == len(lines) - 1 and not justify_last_line) or \
+               len(words) == 1:
+                runs.append(((x, height), line))
+                continue
+            line_without_spaces = ''.join(words)
+            total_size = metrics.size(line_without_spaces)
+            # even spacing between words
+            space_width = (box_width - total_size[0]) / (len(words) - 1.0)
+            start_x = x
+            for word in words[:-1]:
+                runs.append(((start_x, height), word))
+                start_x += metrics.size(word)[0] + space_width
+            last_word_x = x + box_width - metrics.size(words[-1])[0]
+            runs.append(((last_word_x, height), words[-1]))
+        # get height
+        height += text_height
+        # get width
+        if width < line_width:
+            width = line_width
+
+    return Bunch(
+        runs=runs,
+        size=(width, height - y),
+        origin=xy,
+        text=text,
+        box_width=box_width,
+        place=place)
+
+
+def text_sprite(layout, font_filename, font_size, color, cache=None):
+    """
+    The layout (from layout_text_box) rendered as RGBA sprites, one per
+    run: the text in color with its coverage in the alpha channel.
+    Sprites are cached (in SPRITE_CACHE unless another SpriteCache is
+    given; False bypasses caching) by text, font, size, wrap width,
+    alignment and colour, so a text block is only rasterised once
+    wherever it is drawn. See ImageText.draw_sprite. Runs are kept
+    apart so that where their glyphs overlap they blend exactly as when
+    drawn one after another.
+
+    Returns:
+        Bunch with
+            pieces: list of ((x, y), image) with each run's RGBA image,
+                    cropped to its drawn pixels, and its position
+                    relative to the layout's origin.
+            color: the text colour.
+            runs: the layout's runs relative to its origin.
+            nbytes: size of the images in bytes.
+    """
+    if cache is None:
+        cache = SPRITE_CACHE
+    x, y = layout.origin
+    # runs relative to the origin keep any sub-pixel part of their
+    # position, which PIL renders
+    runs = tuple(((run_x - x, run_y - y), text)
+                 for (run_x, run_y), text in layout.runs)
+    key = (layout.text, str(font_filename), font_size, layout.box_width,
+           layout.place, tuple(color))
+    if cache is not False:
+        sprite = cache.get(key)
+        # the same key lays out differently only if a line is wider
+        # than the box and its centring rounds differently
+        if sprite is not None and sprite.runs == runs:
+            return sprite
+
+    metrics = text_metrics(font_filename, font_size)
+    font = load_font(font_filename, font_size)
+    pieces = []
+    nbytes = 0
+    for (run_x, run_y), text in runs:
+        # draw the run's coverage with room for glyphs overhanging
+        # their advance on any side
+        left = int(math.floor(run_x)) - font_size
+        top = int(math.floor(run_y)) - font_size
+        width, height = metrics.size(text)
+        mask = Image.new('L', (width + 3 * font_size, height + 3 * font_size))
+        ImageDraw.Draw(mask).text((run_x - left, run_y - top),
+                                  text,
+                                  font=font,
+                                  fill=255)
+        # crop to the drawn pixels
+        bbox = mask.getbbox()
+        if bbox is None:
+            continue
+        mask = mask.crop(bbox)
+        image = Image.new('RGBA', mask.size, tuple(color) + (255, ))
+        image.putalpha(mask)
+        pieces.append(((left + bbox[0], top + bbox[1]), image))
+        nbytes += 4 * image.size[0] * image.size[1]
+
+    sprite = Bunch(
+        pieces=pieces, color=tuple(color), runs=runs, nbytes=nbytes)
+    if cache is not False:
+        cache.put(key, sprite)
+    return sprite
+
+
+def fit_font_size(fits, min_size=1, max_size=None):
+    """
+    Largest font size in [min_size, max_size] for which fits(font_size)
+    is True, assuming text only grows with the font size (so fits is
+    True up to some size and False above it). Binary searches the range,
+    calling fits at most about log2(max_size - min_size) times. Without
+    max_size the size is doubled from min_size until it no longer fits
+    and the last interval is then searched.
+
+    Returns:
+        The font size, or min_size - 1 if fits(min_size) is False.
+    """
+    if not fits(min_size):
+        return min_size - 1
+    low = min_size
+    if max_size is None:
+        # double until the text no longer fits
+        high = 2 * max(low, 1)
+        while fits(high):
+            low = high
+            high *= 2
+        high -= 1
+    else:
+        high = max_size
+    # invariant: low fits; everything above high doesn't
+    while low < high:
+        middle = (low + high + 1) // 2
+        if fits(middle):
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+
 # function to calculate stroke width from dimensions
 def estimate_stroke_width(image_dims, fraction=0.005):
     """
@@ -91,7 +552,8 @@ class ImageText(object):
     def get_font_size(self, text, font, max_width=None, max_height=None):
         """
         Returns max font size that fulfil max_width and or max_height
-        constraints.
+        constraints. The size is binary searched (see fit_font_size), so
+        only O(log(size)) sizes are measured, each with a cached font.
         """
         # check that at least one constraint has been added
         if max_width is None and max_height is None:
@@ -105,15 +567,14 @@ class ImageText(object):
            (max_height is not None and text_size[1] > max_height):
             raise ValueError("Text can't be filled in only (%dpx, %dpx)" % \
                     text_size)
-        # loop until text width/height limit is reached, incrementing font size
-        while True:
-            # exit condition
-            if (max_width is not None and text_size[0] >= max_width) or \
-               (max_height is not None and text_size[1] >= max_height):
-                return font_size - 1
-            # increment font and text size
-            font_size += 1
+
+        # a size fits while the text is strictly within the limits
+        def fits(font_size):
             text_size = self.get_text_size(font, font_size, text)
+            return (max_width is None or text_size[0] < max_width) and \
+                   (max_height is None or text_size[1] < max_height)
+
+        return fit_font_size(fits)
 
     def write_text(self,
                    xy,
@@ -139,7 +600,7 @@ class ImageText(object):
 
         # otherwise get the text size the usual way
         text_size = self.get_text_size(font_filename, font_size, text)
-        font = ImageFont.truetype(font_filename, font_size)
+        font = load_font(font_filename, font_size)
 
         # (x,y)='center' keyword
         if x == 'center':
@@ -152,11 +613,11 @@ class ImageText(object):
 
     def get_text_size(self, font_filename, font_size, text):
         """
-        Passthrough function for PIL.ImageFont.getsize()
+        Passthrough function for PIL.ImageFont.getsize(), cached per font
+        (see TextMetrics)
         """
 
-        font = ImageFont.truetype(font_filename, font_size)
-        return font.getsize(text)
+        return text_metrics(font_filename, font_size).size(text)
 
     def write_text_box(self,
                        xy,
@@ -167,82 +628,31 @@ class ImageText(object):
                        color=(0, 0, 0),
                        place='left',
                        justify_last_line=False):
-        # unpack position tuple
-        x, y = xy
-        lines = []  # list of wrapped lines
-        line = []  # list of words in current line
-        words = text.split()  # list of all words
+        layout = layout_text_box(xy, text, box_width, font_filename,
+                                 font_size, place, justify_last_line)
+        self.draw_layout(layout, font_filename, font_size, color)
+        return layout.size
 
-        for word in words:
-            new_line = ' '.join(line + [word])
-            # get size of the proposed line
-            size = self.get_text_size(font_filename, font_size, new_line)
-            text_height = size[1]
-            # check that line doesn't exceed box_width
-            if size[0] <= box_width:
-                line.append(word)
-            else:
-                # if the proposed line is too long, append it to the list of lines
-                # set the start of a new line to the current word.
-                lines.append(line)
-                line = [word]
-        # if the current line is not blank
-        if line:
-            lines.append(line)
-        # add spaces to word endings
-        lines = [' '.join(line) for line in lines if line]
-        height = y
-        width = 0
-        # loop over lines and write (account for alignment)
-        for index, line in enumerate(lines):
-            line_width = self.get_text_size(font_filename, font_size, line)[0]
-            # left aligned
-            if place == 'left':
-                self.write_text((x, height), line, font_filename, font_size,
-                                color)
-            # right aligned
-            elif place == 'right':
-                total_size = self.get_text_size(font_filename, font_size, line)
-                x_left = x + box_width - total_size[0]
-                self.write_text((x_left, height), line, font_filename,
-                                font_size, color)
-            # center aligned
-            elif place == 'center':
-                total_size = self.get_text_size(font_filename, font_size, line)
-                x_left = int(x + ((box_width - total_size[0]) / 2))
-                self.write_text((x_left, height), line, font_filename,
-                                font_size, color)
-            # justified
-            elif place == 'justify':
-                words = line.split()
-                if (index == len(lines) - 1 and not justify_last_line) or \
-                   len(words) == 1:
-                    self.write_text((x, height), line, font_filename,
-                                    font_size, color)
-                    continue
-                line_without_spaces = ''.join(words)
-                total_size = self.get_text_size(font_filename, font_size,
-                                                line_without_spaces)
-                # even spacing between words
-                space_width = (box_width - total_size[0]) / (len(words) - 1.0)
-                start_x = x
-                for word in words[:-1]:
-                    self.write_text((start_x, height), word, font_filename,
-                                    font_size, color)
-                    word_size = self.get_text_size(font_filename, font_size,
-                                                   word)
-                    start_x += word_size[0] + space_width
-                last_word_size = self.get_text_size(font_filename, font_size,
-                                                    words[-1])
-                last_word_x = x + box_width - last_word_size[0]
-                self.write_text((last_word_x, height), words[-1],
-                                font_filename, font_size, color)
-            # get height
-            height += text_height
-            # get width
-            if width < line_width:
-                width = line_width
-
-        return (width, height - y)
+    def draw_layout(self, layout, font_filename, font_size, color=(0, 0, 0)):
+        """
+        Draws a layout from layout_text_box.
+        """
+        font = load_font(font_filename, font_size)
+        for xy, text in layout.runs:
+            self.draw.text(xy, text, font=font, fill=color)
+
+    def draw_sprite(self, sprite, xy):
+        """
+        Draws a sprite from text_sprite with its layout's origin at xy
+        (integers), by filling its colour through each piece's alpha
+        channel. This blends each pixel exactly as drawing the text
+        would.
+        """
+        for (x, y), image in sprite.pieces:
+            x += int(xy[0])
+            y += int(xy[1])
+            self.image.paste(sprite.color,
+                             (x, y, x + image.size[0], y + image.size[1]),
+                             image)
 
     # return (box_width, height - y)
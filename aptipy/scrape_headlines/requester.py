@@ -10,24 +10,49 @@ Copyright © 2018, Naim Sen
 Licensed under the terms of the GNU General Public License
 <https://www.gnu.org/licenses/gpl-3.0.en.html>
 """
+import os
 import json
 import random
+import tempfile
+import threading
 from pathlib import Path, PurePath
 import numpy as np
-from ..apti.text import Text
+from ..apti.text import Text, measure_constraints
+from ..apti import utilities
+
+# version of the constraint index file layout
+INDEX_VERSION = 2
 
 
 class Requester(object):
     """
     Attaches to json to serve up headlines. Keeps track of which
     headlines have been served by a single Requester.
+
+    Also keeps an index of each headline's box constraints (see
+    text.measure_constraints) per font file and font size, persisted
+    next to the headlines file (headlines_list.constraints.json). A font
+    and size's entries are measured one headline at a time, the first
+    time each is asked for; build_index measures all of them up front.
+    When the headlines file changes, entries for headlines no longer in
+    it are dropped and the rest are kept. A font's entries are dropped
+    if its file changes.
     """
 
-    def __init__(self, filepath='./aptipy/assets/headlines_list.json'):
+    def __init__(self,
+                 filepath='./aptipy/assets/headlines_list.json',
+                 index_path=None):
         """
-        ctor
+        ctor. index_path defaults to the headlines file's path with the
+        suffix .constraints.json.
         """
         self._path = Path(filepath)
+        if index_path is None:
+            index_path = self._path.with_suffix(".constraints.json")
+        self._index_path = Path(index_path)
+        # loaded on first use
+        self._index = None
+        self._index_lock = threading.Lock()
         # load json file
         with self._path.open() as file:
             self._file_contents = json.load(file)
@@ -43,6 +68,8 @@ class Requester(object):
             item['headline'] for item in self._file_contents
             if 'headline' in item
         ]
+        # invalidates index entries for headlines no longer in the file
+        self._headlines_signature = self._signature(self._path)
         # list of served indices
         self._served_indices = []
 
@@ -63,6 +90,129 @@ class Requester(object):
             self._served_indices.append(rand_index)
             return (self._headlines[rand_index], rand_index)
 
+    # ~~ Constraint index ~~ #
+    @staticmethod
+    def _signature(path):
+        """
+        Modification time and size of the file at path, which change
+        whenever it is edited.
+        """
+        stat = path.stat()
+        return [stat.st_mtime_ns, stat.st_size]
+
+    @classmethod
+    def _font_key(cls, font_path, font_size):
+        """
+        Index key and signature of a font file in a size. Entries are
+        keyed by the font's resolved path, and the signature (the file's
+        modification time and size) invalidates them when the file
+        changes.
+        """
+        font_path = Path(font_path).resolve()
+        return ("{}@{}".format(font_path, font_size),
+                cls._signature(font_path))
+
+    def _load_index(self):
+        """
+        Reads the persisted index, or starts an empty one if there is
+        none (or it can't be read).
+        """
+        try:
+            with self._index_path.open() as file:
+                index = json.load(file)
+            if index.get('version') == INDEX_VERSION:
+                return index
+        except (OSError, ValueError):
+            pass
+        return {'version': INDEX_VERSION, 'headlines': None, 'fonts': {}}
+
+    def _save_index(self):
+        """
+        Writes the index atomically. An index that can't be written (e.g.
+        a read-only install) is kept in memory only.
+        """
+        try:
+            handle, tmp_path = tempfile.mkstemp(
+                dir=str(self._index_path.parent), suffix=".tmp")
+            with os.fdopen(handle, 'w') as file:
+                json.dump(self._index, file)
+            os.replace(tmp_path, str(self._index_path))
+        except OSError:
+            print("WARNING: Could not write constraint index to",
+                  self._index_path)
+
+    def _entries(self, font_path, font_size, headline=None):
+        """
+        The index entries for font_path in font_size. Measures headline
+        if it is missing from them, or every missing headline if headline
+        is None, and saves the index if any were added. Must be called
+        with the index lock held.
+        """
+        if self._index is None:
+            self._index = self._load_index()
+            if self._index.get('headlines') != self._headlines_signature:
+                # the headlines file has changed: forget the headlines
+                # it no longer has
+                headlines = set(self._headlines)
+                for font_index in self._index['fonts'].values():
+                    font_index['headlines'] = {
+                        text: entry
+                        for text, entry in font_index['headlines'].items()
+                        if text in headlines
+                    }
+                self._index['headlines'] = self._headlines_signature
+        key, signature = self._font_key(font_path, font_size)
+        font_index = self._index['fonts'].get(key)
+        if font_index is None or font_index['signature'] != signature:
+            # new font or size, or the font file has changed
+            font_index = {'signature': signature, 'headlines': {}}
+            self._index['fonts'][key] = font_index
+        entries = font_index['headlines']
+        if headline is None:
+            missing = set(self._headlines).difference(entries)
+        else:
+            missing = {headline}.difference(entries)
+        for headline in missing:
+            entries[headline] = measure_constraints(
+                headline, str(font_path), font_size).__dict__
+        if missing:
+            self._save_index()
+        return entries
+
+    def build_index(self, font_path, font_size):
+        """
+        Measures every headline not yet in the index for font_path in
+        font_size, and saves the index if any were added.
+
+        Returns:
+            The number of headlines in the index for font_path and
+            font_size.
+        """
+        with self._index_lock:
+            return len(self._entries(font_path, font_size))
+
+    def measurements(self, index, font_path, font_size):
+        """
+        Measurements of the headline at index in font_path and font_size,
+        from the index (measured first if it isn't there yet).
+
+        Returns:
+            Bunch with min_size, area and word_widths (see
+            text.measure_constraints).
+        """
+        headline = self._headlines[index]
+        with self._index_lock:
+            entries = self._entries(font_path, font_size, headline)
+            return utilities.Bunch(**entries[headline])
+
+    def constraints(self, index, font_path, font_size):
+        """
+        Minimum box size and area of the headline at index, as
+        Text.get_constraints returns them, looked up in the index.
+        """
+        measurements = self.measurements(index, font_path, font_size)
+        return np.array(measurements.min_size), measurements.area
+
 
 def main():
     headline_server = Requester()
@@ -73,9 +223,13 @@ def main():
         r'../salience-in-photographs/aptipy/assets/BBCReith/BBCReithSans_Bd.ttf'
     ).resolve()
     text_ctx = Text('raw', fontpath, size_pt=24)
-    # get constraints
+    # get constraints (fonts come from the process-wide cache)
     vals = text_ctx.get_constraints(hl)
     print(vals)
+    # and from the constraint index
+    print(headline_server.constraints(idx, fontpath, 24))
+    print("font cache hits:", utilities.FONT_CACHE.hits, "misses:",
+          utilities.FONT_CACHE.misses)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,143 @@
+"""
+Regression tests for the box descents.
+"""
+
+import copy
+
+import cv2
+import numpy as np
+import pytest
+
+from aptipy.apti import bounding_box, box_factory, directions_factory
+from aptipy.apti.bounding_box import Box
+
+
+@pytest.fixture
+def s_map():
+    noise = np.random.RandomState(0).rand(120, 160) * 255
+    return cv2.GaussianBlur(noise, (0, 0), 6).astype(np.uint8)
+
+
+def starting_boxes(s_map, n_boxes=12):
+    random = np.random.RandomState(1)
+    boxes = []
+    while len(boxes) < n_boxes:
+        dims = random.randint(20, 60, size=2)
+        box_tl = random.randint(0, np.array(s_map.shape) - dims)
+        boxes.append(Box(s_map, box_tl, dims, np.array([15, 15]), 300))
+    return boxes
+
+
+@pytest.mark.parametrize("search", ["descent", "adaptive"])
+def test_memo_does_not_change_descent(s_map, search):
+    directions = directions_factory.unconstrained()
+    boxes = starting_boxes(s_map)
+    plain_boxes = [
+        bounding_box.minimise_cost(box, directions, 4, search=search)
+        for box in boxes
+    ]
+    # the memo is opt-in, down to single box costs
+    assert len(boxes[0].engine.memo) == 0
+    for box, plain in zip(boxes, plain_boxes):
+        memoised = bounding_box.minimise_cost(
+            box, directions, 4, search=search, use_memo=True)
+        assert memoised.rect == plain.rect
+        assert memoised.metadata.cost_history == \
+            plain.metadata.cost_history
+
+
+def test_batched_descent_matches_minimise_cost(s_map):
+    boxes = starting_boxes(s_map)
+    # direction sets of different lengths
+    factories = [
+        directions_factory.unconstrained, directions_factory.left_anchored,
+        directions_factory.topright_anchored
+    ]
+    directions_lists = [
+        factories[index % len(factories)]() for index in range(len(boxes))
+    ]
+    step_sizes = [3 + index % 4 for index in range(len(boxes))]
+    batched = bounding_box.minimise_costs_batched(boxes, directions_lists,
+                                                  step_sizes)
+    for box, directions, step_size, optimum in zip(
+            boxes, directions_lists, step_sizes, batched):
+        expected = bounding_box.minimise_cost(box, directions, step_size)
+        assert optimum.rect == expected.rect
+        assert optimum.metadata.cost_history == \
+            expected.metadata.cost_history
+        assert optimum.metadata.n_evaluations == \
+            expected.metadata.n_evaluations
+
+
+def test_batched_descent_of_no_boxes():
+    assert bounding_box.minimise_costs_batched([], []) == []
+
+
+def test_search_options_reach_exhaustive_search(s_map):
+    box = starting_boxes(s_map, 1)[0]
+    optimum = bounding_box.minimise_cost(
+        box, [], search="exhaustive", search_options=dict(top_k=3))
+    assert len(optimum.metadata.alternatives) == 3
+    optima = box_factory.minimise_boxes(
+        [box], [[]],
+        search="exhaustive",
+        backend="batched",
+        search_options=dict(grid_step=7, shape_step=9))
+    expected = bounding_box.exhaustive_search(box, grid_step=7, shape_step=9)
+    assert optima[0].rect == expected.rect
+
+
+def test_search_options_reach_pyramid_search(s_map):
+    box = starting_boxes(s_map, 1)[0]
+    optimum = bounding_box.minimise_cost(
+        box, [], search="pyramid", search_options=dict(coarse_side=32))
+    expected = bounding_box.pyramid_search(box, coarse_side=32)
+    assert optimum.rect == expected.rect
+    assert len(optimum.metadata.level_timings) == 4
+
+
+def loop_minimise_cost(starting_box, directions_list, step_size):
+    """
+    minimise_cost as it was before candidates were scored in one
+    vectorised pass: one transformed_cost per direction.
+    """
+    optimum_box = copy.copy(starting_box)
+    while True:
+        candidate_vectors = [np.array([[0, 0], [0, 0]])]
+        candidate_costs = [optimum_box.cost]
+        for vector in directions_list:
+            candidate_cost = optimum_box.transformed_cost(step_size * vector)
+            if candidate_cost is None:
+                continue
+            candidate_vectors.append(vector)
+            candidate_costs.append(candidate_cost)
+        best_cost = min(candidate_costs)
+        best_vector = candidate_vectors[candidate_costs.index(best_cost)]
+        optimum_box.metadata.cost_history.append(best_cost)
+        if np.all(best_vector == 0):
+            return optimum_box
+        optimum_box.transform(step_size * best_vector)
+
+
+def test_evaluate_candidates_matches_transformed_cost(s_map):
+    directions = directions_factory.unconstrained()
+    for box in starting_boxes(s_map):
+        for step_size in (1, 5, 40):
+            expected = [
+                box.transformed_cost(step_size * vector)
+                for vector in directions
+            ]
+            expected = [np.inf if cost is None else cost for cost in expected]
+            np.testing.assert_array_equal(
+                bounding_box.evaluate_candidates(box, directions, step_size),
+                expected)
+
+
+def test_descent_matches_per_direction_loop(s_map):
+    directions = directions_factory.unconstrained()
+    for box in starting_boxes(s_map):
+        expected = loop_minimise_cost(box, directions, 3)
+        optimum = bounding_box.minimise_cost(box, directions, 3)
+        assert optimum.rect == expected.rect
+        assert optimum.metadata.cost_history == \
+            expected.metadata.cost_history
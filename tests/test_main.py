@@ -0,0 +1,66 @@
+"""
+Regression tests for the folder runners.
+"""
+
+import threading
+
+import cv2
+import numpy as np
+import pytest
+
+from aptipy.apti import box_factory, main
+
+# ImageFont.getsize is deprecated in recent Pillow
+pytestmark = pytest.mark.filterwarnings("ignore::DeprecationWarning")
+
+
+@pytest.fixture
+def img_paths(tmp_path):
+    paths = []
+    for seed in range(8):
+        noise = np.random.RandomState(seed).rand(120, 160, 3) * 255
+        path = tmp_path / "img{}.jpg".format(seed)
+        cv2.imwrite(str(path),
+                    cv2.GaussianBlur(noise, (0, 0), 10).astype(np.uint8))
+        paths.append(str(path))
+    return paths
+
+
+def run_pipelined(img_paths, tmp_path):
+    return main.run_pipelined(
+        img_paths, str(tmp_path / "out"), queue_size=1, backend="batched")
+
+
+def test_search_error_stops_pipeline(img_paths, tmp_path, monkeypatch):
+    minimise_boxes = box_factory.minimise_boxes
+    n_calls = [0]
+
+    def failing_minimise_boxes(*args, **kwargs):
+        n_calls[0] += 1
+        if n_calls[0] == 2:
+            raise RuntimeError("search failed")
+        return minimise_boxes(*args, **kwargs)
+
+    monkeypatch.setattr(box_factory, "minimise_boxes",
+                        failing_minimise_boxes)
+    n_threads = threading.active_count()
+    with pytest.raises(RuntimeError, match="search failed"):
+        run_pipelined(img_paths, tmp_path)
+    for thread in threading.enumerate():
+        if thread.daemon:
+            thread.join(timeout=5)
+    assert threading.active_count() <= n_threads
+    assert n_calls[0] == 2
+
+
+def test_write_error_is_raised_early(img_paths, tmp_path, monkeypatch):
+    n_calls = [0]
+
+    def failing_write_boxes(*args, **kwargs):
+        n_calls[0] += 1
+        raise OSError("disk full")
+
+    monkeypatch.setattr(box_factory, "write_boxes", failing_write_boxes)
+    with pytest.raises(OSError, match="disk full"):
+        run_pipelined(img_paths, tmp_path)
+    assert n_calls[0] < len(img_paths)
@@ -0,0 +1,103 @@
+"""
+Regression tests for the Requester's constraint index.
+"""
+
+import os
+import json
+import shutil
+
+import pytest
+
+from aptipy.apti import utilities
+from aptipy.apti.text import measure_constraints
+from aptipy.scrape_headlines import requester
+from aptipy.scrape_headlines.requester import Requester
+
+HEADLINES_PATH = utilities.FONT_DIR.parent / "headlines_list.json"
+FONT_SIZE = 24
+
+# ImageFont.getsize is deprecated in recent Pillow
+pytestmark = pytest.mark.filterwarnings("ignore::DeprecationWarning")
+
+
+@pytest.fixture
+def items():
+    with HEADLINES_PATH.open() as file:
+        return json.load(file)[:6]
+
+
+@pytest.fixture
+def headlines_path(tmp_path, items):
+    path = tmp_path / "headlines.json"
+    path.write_text(json.dumps(items))
+    return path
+
+
+@pytest.fixture
+def font_path(tmp_path):
+    path = tmp_path / "font.ttf"
+    shutil.copy(str(utilities.FONT_DIR / "BBCReithSans_Bd.ttf"), str(path))
+    return path
+
+
+@pytest.fixture
+def measured(monkeypatch):
+    """
+    List of the headlines the Requester measures.
+    """
+    headlines = []
+
+    def counting_measure(headline, font_filename, font_size):
+        headlines.append(headline)
+        return measure_constraints(headline, font_filename, font_size)
+
+    monkeypatch.setattr(requester, "measure_constraints", counting_measure)
+    return headlines
+
+
+def test_lookup_measures_only_the_requested_headline(
+        headlines_path, font_path, items, measured):
+    server = Requester(headlines_path)
+    min_size, area = server.constraints(2, font_path, FONT_SIZE)
+    assert measured == [items[2]['headline']]
+    expected = measure_constraints(items[2]['headline'], str(font_path),
+                                   FONT_SIZE)
+    assert list(min_size) == list(expected.min_size)
+    assert area == expected.area
+
+    # persisted, and extended one headline at a time
+    server = Requester(headlines_path)
+    server.constraints(2, font_path, FONT_SIZE)
+    server.constraints(4, font_path, FONT_SIZE)
+    assert measured == [items[2]['headline'], items[4]['headline']]
+    assert server.build_index(font_path, FONT_SIZE) == len(items)
+    assert len(measured) == len(items)
+
+
+def test_changed_headlines_file_drops_removed_headlines(
+        headlines_path, font_path, items, measured):
+    Requester(headlines_path).build_index(font_path, FONT_SIZE)
+    del measured[:]
+    replaced = items[0]['headline']
+    items[0] = dict(items[0], headline="A headline that was not there")
+    headlines_path.write_text(json.dumps(items))
+
+    server = Requester(headlines_path)
+    assert server.build_index(font_path, FONT_SIZE) == len(items)
+    assert measured == [items[0]['headline']]
+    with server._index_path.open() as file:
+        entries, = [
+            font_index['headlines']
+            for font_index in json.load(file)['fonts'].values()
+        ]
+    assert replaced not in entries
+
+
+def test_changed_font_file_is_measured_again(headlines_path, font_path,
+                                             measured):
+    Requester(headlines_path).constraints(1, font_path, FONT_SIZE)
+    stat = font_path.stat()
+    os.utime(str(font_path), ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+    Requester(headlines_path).constraints(1, font_path, FONT_SIZE)
+    assert len(measured) == 2
@@ -0,0 +1,55 @@
+"""
+Regression tests for the saliency backends.
+"""
+
+import cv2
+import numpy as np
+import pytest
+
+from aptipy.apti import saliency_backends
+
+# float rounding, and OpenCV's float32 output
+TOLERANCE = 1e-4
+
+
+def sky_with_dark_block():
+    rows, cols = np.mgrid[0:192, 0:256]
+    sky = np.dstack([180 + 60 * rows / 192, 140 + 50 * rows / 192,
+                     90 + 40 * rows / 192]).astype(np.uint8)
+    sky[60:100, 100:160] = 20
+    return sky
+
+
+def blurred_noise(seed, sigma, shape=(256, 256, 3)):
+    noise = np.random.RandomState(seed).rand(*shape) * 255
+    return cv2.GaussianBlur(noise, (0, 0), sigma).astype(np.uint8)
+
+
+IMAGES = {
+    "sky": sky_with_dark_block(),
+    "gradient": np.tile(np.linspace(0, 255, 256), (256, 1)).astype(np.uint8),
+    "flat": np.full((100, 100), 128, np.uint8),
+    "thumbnail": blurred_noise(0, 3, (64, 64)),
+}
+IMAGES.update(("noise_{}".format(sigma), blurred_noise(sigma, sigma))
+              for sigma in (1, 4, 12, 30))
+
+
+@pytest.mark.parametrize("name", sorted(IMAGES))
+def test_numpy_spectral_residual_matches_opencv(name):
+    image = IMAGES[name]
+    expected = saliency_backends.get_backend("spectral_residual").compute(image)
+    actual = saliency_backends.numpy_spectral_residual(image)
+    assert actual.shape == expected.shape
+    np.testing.assert_allclose(actual, expected, rtol=0, atol=TOLERANCE)
+
+
+def test_spectral_residual_batch_matches_single():
+    thumbnails = np.stack([
+        saliency_backends.to_thumbnail(IMAGES[name])
+        for name in ("sky", "gradient", "noise_4")
+    ])
+    batch = saliency_backends.spectral_residual(thumbnails)
+    for thumbnail, saliency_map in zip(thumbnails, batch):
+        np.testing.assert_allclose(
+            saliency_backends.spectral_residual(thumbnail), saliency_map)
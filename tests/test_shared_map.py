@@ -0,0 +1,47 @@
+"""
+Regression tests for sharing saliency maps with pool workers.
+"""
+
+import sys
+
+import cv2
+import numpy as np
+import pytest
+
+from aptipy.apti import box_factory, directions_factory, shared_map
+from aptipy.apti.bounding_box import Box
+
+
+@pytest.fixture
+def s_map():
+    noise = np.random.RandomState(0).rand(120, 160) * 255
+    return cv2.GaussianBlur(noise, (0, 0), 6).astype(np.uint8)
+
+
+def n_mappings(path):
+    with open("/proc/self/maps") as maps:
+        return sum(path in line for line in maps)
+
+
+@pytest.mark.skipif(not sys.platform.startswith("linux"),
+                    reason="reads /proc/self/maps")
+@pytest.mark.parametrize("search", ["descent", "pyramid", "exhaustive"])
+def test_worker_releases_mapping_after_task(s_map, search):
+    box = Box(s_map, (10, 10), (40, 40), np.array([15, 15]), 300)
+    with shared_map.SharedMap(s_map) as shared:
+        map_path = shared.handle[0]
+        box_factory.minimise_shared(shared.handle, box.rect, box.min_size,
+                                    box.min_area,
+                                    directions_factory.unconstrained(), 5,
+                                    1000, search)
+        assert n_mappings(map_path) == 0
+
+
+def test_close_removes_files_once(s_map, tmp_path):
+    shared = shared_map.SharedMap(s_map, directory=str(tmp_path))
+    attached, engine = shared_map.attach(shared.handle)
+    np.testing.assert_array_equal(attached, s_map)
+    del attached, engine
+    shared.close()
+    assert list(tmp_path.iterdir()) == []
+    shared.close()
@@ -0,0 +1,87 @@
+"""
+Regression tests for text measuring and rendering.
+"""
+
+import json
+import random
+
+import pytest
+from PIL import Image
+
+from aptipy.apti import utilities
+
+HEADLINES_PATH = utilities.FONT_DIR.parent / "headlines_list.json"
+FONT_FILENAMES = ("BBCReithSans_Bd.ttf", "BBCReithSansCd_Rg.ttf")
+FONT_SIZES = (11, 24, 57)
+
+# ImageFont.getsize is deprecated in recent Pillow
+pytestmark = pytest.mark.filterwarnings("ignore::DeprecationWarning")
+
+
+@pytest.fixture(scope="module")
+def headlines():
+    with HEADLINES_PATH.open() as file:
+        items = json.load(file)
+    return random.Random(0).sample([item['headline'] for item in items], 60)
+
+
+def greedy_wrap(font, words, box_width):
+    """
+    Line breaking as ImageText.write_text_box did before TextMetrics:
+    every candidate line is measured in full.
+    """
+    lines = []
+    line = []
+    text_height = None
+    for word in words:
+        size = font.getsize(' '.join(line + [word]))
+        text_height = size[1]
+        if size[0] <= box_width:
+            line.append(word)
+        else:
+            lines.append(line)
+            line = [word]
+    if line:
+        lines.append(line)
+    return [line for line in lines if line], text_height
+
+
+@pytest.mark.parametrize("font_filename", FONT_FILENAMES)
+@pytest.mark.parametrize("font_size", FONT_SIZES)
+def test_wrap_matches_greedy_wrap(headlines, font_filename, font_size):
+    font_path = str(utilities.FONT_DIR / font_filename)
+    font = utilities.load_font(font_path, font_size)
+    metrics = utilities.text_metrics(font_path, font_size)
+    for headline in headlines:
+        words = headline.split()
+        box_widths = [scale * font_size for scale in (3, 6, 10, 17)]
+        # widths at which a line only just fits, or only just doesn't
+        for n_words in range(2, min(len(words), 5) + 1):
+            line_width = font.getsize(' '.join(words[:n_words]))[0]
+            box_widths += [line_width - 1, line_width, line_width + 1]
+        for box_width in box_widths:
+            assert metrics.wrap(words, box_width) == \
+                greedy_wrap(font, words, box_width)
+
+
+@pytest.mark.parametrize("place", ("left", "right", "center", "justify"))
+def test_sprite_blit_matches_drawing(headlines, place):
+    noise = Image.effect_noise((320, 240), 64).convert("RGBA")
+    font_path = str(utilities.FONT_DIR / FONT_FILENAMES[0])
+    cache = utilities.SpriteCache()
+    for index, headline in enumerate(headlines[:20]):
+        font_size = FONT_SIZES[index % len(FONT_SIZES)]
+        # includes boxes partly outside the image
+        xy = ((index * 37) % 300 - 20, (index * 53) % 220 - 10)
+        layout = utilities.layout_text_box(xy, headline, 60 + index * 9,
+                                           font_path, font_size, place)
+        drawn = utilities.ImageText(noise.copy())
+        drawn.draw_layout(layout, font_path, font_size, (255, 210, 47))
+        # render once, then blit from the cache
+        for _ in range(2):
+            sprite = utilities.text_sprite(layout, font_path, font_size,
+                                           (255, 210, 47), cache)
+            blitted = utilities.ImageText(noise.copy())
+            blitted.draw_sprite(sprite, xy)
+            assert blitted.image.tobytes() == drawn.image.tobytes()
+    assert cache.hits == 20